@@ -24,3 +24,18 @@ class Config:
     STATIC_FOLDER = "static"
     TEMPLATES_FOLDER = "templates"
     COMPRESSOR_DEBUG = environ.get("COMPRESSOR_DEBUG")
+
+    # Artifact store of expensive scene stages
+    ARTIFACT_DIR = environ.get("ARTIFACT_DIR", path.join(BASE_DIR, ".artifacts"))
+    ARTIFACT_MAX_BYTES = int(environ.get("ARTIFACT_MAX_BYTES", 4 * 2 ** 30))
+
+    # Scenes of the sessions connected to the dashboard
+    SESSION_MAX_BYTES = int(environ.get("SESSION_MAX_BYTES", 2 * 2 ** 30))
+    SESSION_IDLE_TIMEOUT = float(environ.get("SESSION_IDLE_TIMEOUT", 3600))
+
+    # Scenes shared by the server's worker processes, kept for STATE_MAX_AGE seconds after their last change
+    STATE_DIR = environ.get("STATE_DIR", path.join(BASE_DIR, ".state"))
+    STATE_MAX_AGE = float(environ.get("STATE_MAX_AGE", 7 * 24 * 3600))
+
+    # Worker processes running long calculations
+    JOB_WORKERS = int(environ.get("JOB_WORKERS", 2))
@@ -1,21 +1,55 @@
+import os
+import shutil
+import tempfile
+import threading
+
 import numpy as np
-from numpy import sqrt, arctan, log  # import sqrt and arctan function
-from numpy import power as p  # Allows for element-wise power
-from numpy import multiply as m  # Allows element-wise multiplication
-from numpy import divide as d  # Allows for element-wise division
 from scipy.ndimage import gaussian_filter
 import pandas as pd
-from scipy import interpolate
 from randomfield.randomq512 import mainfunc
 from randomfield.rando2asc import bin2asc
 import pyvista as pv
+from .gridding import LOCAL_METHODS, local_grid, local_leave_one_out
+from .jobs import split_progress
+from .grids import RegularGrid, StationInterpolator
+from .pipeline import PRODUCT_FIELDS, ProductGraph, StageScheduler, freeze, product
+from .state import StateConflict
+from .gravity import (ENGINE_VERSION, voxel_gravity, voxel_gravity_multi, richardson_extrapolate, taylor_shift,
+                      terrain_gravity_at)
+from .survey import LAYOUTS, clip_to_bounds
+from .voxels import IMPLICIT_SHAPES, VoxelModel, voxelize_implicit, voxelize_inside
+
+# Template of the parameter file of the random field generator
+RANDOM_FIELD_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inputFile')
+# The generator reads and writes fixed file names in the working directory, which is one per process
+_random_field_lock = threading.Lock()
+
+
+class Snapshot:
+    """
+    Products of a Scene as they were at one version, for rendering.
+
+    It has the Scene's product attributes with read-only arrays, and does not change when
+    the Scene's products are recalculated, so it can be read while they are.
+    """
+    def __init__(self, version, scene):
+        self.version = version
+        for name in PRODUCT_FIELDS:
+            setattr(self, name, freeze(getattr(scene, name)))
 
 
 class Scene:
-    def __init__(self, name):
+    def __init__(self, name, store=None, state=None):
         self.name = name
+        # ArtifactStore caching the arrays of expensive stages on disk, if any
+        self.store = store
+        # SceneState saving the Scene for the other worker processes of the server, if any,
+        # and the version of it this Scene was loaded as or last saved as
+        self.state = state
+        self.state_version = None
         self.scene_properties = dict(model_bounds=[],
                                      scene_bounds=[],
+                                     grid=None,
                                      edge_distance_factor=[],
                                      resolution=[],
                                      datum=[],
@@ -24,10 +58,13 @@ class Scene:
                                               vertices=[],
                                               centre=[],
                                               radius=1,
+                                              length=None,
+                                              shape=None,
+                                              parameters=None,
                                               pv_model=None),
                                     voxel=dict(indices=[],
                                                vertices=[],
-                                               vertices_filled=[],
+                                               model=None,
                                                centre=[],
                                                resolution=None),
                                     wireframe=[])
@@ -37,7 +74,8 @@ class Scene:
         self.terrain = dict(true=dict(elevation=[],
                                       gravity=[]),
                             dem=dict(elevation=[],
-                                     gravity=[]))
+                                     gravity=[]),
+                            density=None)
         self.corrections = dict(free_air=[],
                                 terrain=[])
         self.data = dict(perfect_gravity=dict(terrain=None,
@@ -48,16 +86,30 @@ class Scene:
                          noisy_gravity=dict(target=None,
                                             full=None),
                          interp_gravity=dict(target=None,
-                                             full=None),
+                                             full=None,
+                                             terrain_correction=None),
+                         gravity_error=dict(target=None,
+                                            full=None),
+                         cv_error=None,
                          corrected_gravity=dict(full=None,
                                                 interp=None),
                          elevation=dict(terrain=[],
                                         dem=None))
-        self.measurements = dict(locations=dict(target=[],
+        self.measurements = dict(stations=dict(),
+                                 locations=dict(target=[],
                                                 full=[]),
                                  points=dict(target=[list(), list(), list()],
                                              full=[list(), list(), list()],
-                                             raw=[list(), list(), list()]))
+                                             raw=[list(), list(), list()]),
+                                 cross_validation=dict(method=None,
+                                                       error=None,
+                                                       stats=None))
+        self.interpolators = dict()
+        # Interpolation and cross-validation look up and add interpolators concurrently
+        self._interpolators_lock = threading.Lock()
+        self.products = ProductGraph()
+        # Called with the fraction done of a calculation run as a job, see jobs.JobQueue
+        self.progress = None
         self.sim_params = {'x position': None,
                            'y position': None,
                            'Calculation Resolution': None,
@@ -73,7 +125,88 @@ class Scene:
                            'Background/Terrain Density': None,
                            'Gravimeter Error': None,
                            'GPS Error': None}
+        self._snapshot = Snapshot(0, self)
+
+    def __getstate__(self):
+        # The pyvista mesh wraps a VTK object, so it is rebuilt from its vertices and faces on loading
+        state = self.__dict__.copy()
+        state['_snapshot'] = state['_snapshot'].version
+        state['progress'] = None
+        state['state'] = state['state_version'] = None
+        del state['_interpolators_lock']
+        mesh = dict(state['target_geometry']['mesh'], pv_model=None)
+        state['target_geometry'] = dict(state['target_geometry'], mesh=mesh)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._interpolators_lock = threading.Lock()
+        mesh = self.target_geometry['mesh']
+        if len(mesh['vertices']):
+            indices = np.asarray(mesh['indices'])
+            faces = np.column_stack([np.full(len(indices), indices.shape[1]), indices])
+            mesh['pv_model'] = pv.PolyData(np.asarray(mesh['vertices']), faces.ravel())
+        self._snapshot = Snapshot(self._snapshot, self)
+
+    def publish(self, blocking=False):
+        """
+        Publishes the current products as a new snapshot, unless a product is being calculated.
+
+        A snapshot taken during a calculation could hold part of its results, so publishing
+        is then left to the last of the running calculations to finish, or with
+        blocking=True waits for them to. Returns whether the snapshot was published.
+        """
+        if not self.products.computing.acquire_exclusive(blocking=blocking):
+            return False
+        try:
+            self._snapshot = Snapshot(self._snapshot.version + 1, self)
+            self._save()
+        finally:
+            self.products.computing.release_exclusive()
+        return True
+
+    def save(self):
+        """
+        Saves the Scene to its SceneState, if it has one, unless a product is being calculated.
+
+        The last of the running calculations to finish saves the Scene when it publishes its
+        products. Returns whether the Scene was saved, which it is not either if another
+        process has saved the Scene since this copy was loaded, see _save.
+        """
+        if not self.products.computing.acquire_exclusive(blocking=False):
+            return False
+        try:
+            return self._save()
+        finally:
+            self.products.computing.release_exclusive()
+
+    def _save(self):
+        if self.state is None:
+            return True
+        try:
+            self.state_version = self.state.save(self.name, self, self.state_version)
+        except StateConflict:
+            # The stored Scene is newer, so it is kept rather than overwritten by this copy:
+            # the registry loads it on the session's next request
+            return False
+        return True
+
+    def snapshot(self):
+        """The latest published Snapshot of the products."""
+        return self._snapshot
+
+    def _cached(self, stage, compute, **inputs):
+        """
+        Arrays of stage for inputs, as a dict returned by compute.
+
+        With an artifact store they are loaded from it if the stage has been calculated for
+        the same inputs and engine version before, and stored after calculating otherwise.
+        """
+        if self.store is None:
+            return compute()
+        return self.store.cached(stage, compute, engine=ENGINE_VERSION, **inputs)
 
+    @product('datum', deps=['voxels'], files=['path'])
     def create_datum(self, resolution, extent_multiplier=None,
                      extent_x1=None, extent_y1=None, extent_x2=None, extent_y2=None,
                      path=None, dem_res=None):
@@ -129,9 +262,11 @@ class Scene:
         self.scene_properties['scene_bounds'] = [np.min(xx_sampled), np.min(yy_sampled),
                                                  np.max(xx_sampled), np.max(yy_sampled)]
         self.scene_properties['datum'] = [xx_sampled, yy_sampled, np.zeros_like(zz_sampled)]
+        self.scene_properties['grid'] = RegularGrid.from_mesh(xx_sampled, yy_sampled, spacing=resolution)
         self.scene_properties['resolution'] = resolution
         self.sim_params['Calculation Resolution'] = str(resolution)
 
+    @product('mesh', files=['path'])
     def render_mesh(self,
                     centre_depth,
                     centre_x,
@@ -149,6 +284,7 @@ class Scene:
         elif shape == 'cylinder':
             mesh = pv.Cylinder(radius=radius, height=length)
             mesh = mesh.triangulate()
+            self.target_geometry['mesh']['radius'] = radius
 
         mesh.translate(np.array([-1, -1, -1]) * np.array([mesh.center[0], mesh.center[1], mesh.bounds[5]]))
         mesh.translate(np.array([centre_x, centre_y, centre_depth]))
@@ -160,39 +296,89 @@ class Scene:
         self.target_geometry['mesh']['vertices'] = vertices
         self.target_geometry['mesh']['pv_model'] = mesh
         self.target_geometry['mesh']['centre'] = mesh.center
+        self.target_geometry['mesh']['shape'] = None if path else shape
+        # Arguments of the shape's function in voxels.IMPLICIT_SHAPES besides its centre
+        self.target_geometry['mesh']['parameters'] = None if path else (
+            dict(radius=radius) if shape == 'sphere' else dict(radius=radius, length=length))
+        self.target_geometry['mesh']['length'] = length
 
         self.sim_params['Target Depth'] = str(centre_depth) + ' m'
 
-    def voxelize_mesh(self, resolution):
-        """Creates a voxel model of the stored scene mesh data."""
-        mesh = self.target_geometry['mesh']['pv_model']
-        vox = pv.voxelize(mesh, resolution, check_surface=False)
-        vox_surface = vox.extract_surface()
-        vox_mesh = vox_surface.triangulate()
-        faces = (vox_surface.faces, vox_mesh.faces)
-        vertices = (vox_surface.points, vox_mesh.points, vox.cell_centers().points)
-
-        # get the i, j, k for the vertices of the mesh, voxel surface, and voxel mesh
-        indices = list()
-        for i in faces:
-            vertices_per_cell = i[0]
-            indices.append(i.reshape(-1, vertices_per_cell + 1)[:, 1:vertices_per_cell + 1])
-
-        # extract the lists of x, y, z coordinates of the triangle vertices and connect them by a line
-        x_wire, y_wire, z_wire = [], [], []
-        for T in vertices[0][indices[0]]:
-            x_wire.extend([T[k % 4][0] for k in range(5)] + [float('nan')])
-            y_wire.extend([T[k % 4][1] for k in range(5)] + [float('nan')])
-            z_wire.extend([T[k % 4][2] for k in range(5)] + [float('nan')])
-
-        self.target_geometry['voxel']['indices'] = indices[1]
-        self.target_geometry['voxel']['vertices'] = vertices[1]
-        self.target_geometry['voxel']['vertices_filled'] = vertices[2]
-        self.target_geometry['wireframe'] = np.array([x_wire, y_wire, z_wire])
+    @product('voxels', deps=['mesh'])
+    def voxelize_mesh(self, resolution, fractional=False):
+        """
+        Creates a voxel model of the stored scene mesh data.
+
+        Spheres and cylinders are voxelized directly from their signed distance function
+        rather than by point-in-mesh tests against the rendered surface. With fractional=True,
+        each voxel also keeps the fraction of its volume inside the target (exact for the
+        parametric shapes, sampled for meshes), which the gravity calculation weights it by.
+        """
+        model = self._voxel_model(resolution, fractional)
+        vertices, quads = model.surface()
+
+        # split each exposed voxel face into two triangles for display
+        indices = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+
+        # outline each face with a closed line, separated from the next face by a nan
+        outline = vertices[quads[:, [0, 1, 2, 3, 0]]]
+        outline = np.concatenate([outline, np.full((len(quads), 1, 3), np.nan)], axis=1).reshape(-1, 3)
+
+        self.target_geometry['voxel']['indices'] = indices
+        self.target_geometry['voxel']['vertices'] = vertices
+        self.target_geometry['voxel']['model'] = model
+        self.target_geometry['wireframe'] = outline.T
         self.target_geometry['voxel']['resolution'] = resolution
-        self.scene_properties['model_bounds'] = np.round(vox.bounds, 0)
+        self.scene_properties['model_bounds'] = np.round(model.bounds, 0)
         self.sim_params['Voxel Resolution'] = str(resolution) + ' m'
 
+    def _voxel_model(self, resolution, fractional=False):
+        """Voxelizes the stored target at the given resolution without storing the result."""
+        shape = self.target_geometry['mesh']['shape']
+        mesh = self.target_geometry['mesh']['pv_model']
+        params = self.target_geometry['mesh']
+        parameters = params.get('parameters')
+        implicit = shape in IMPLICIT_SHAPES and parameters is not None
+
+        def voxelize():
+            if implicit:
+                sdf, bounds = IMPLICIT_SHAPES[shape](centre=params['centre'], **parameters)
+                model = VoxelModel.from_lattice(voxelize_implicit(sdf, bounds, resolution, fractional=fractional))
+            elif fractional:
+                def inside(x, y, z):
+                    points = pv.PolyData(np.column_stack([x, y, z]))
+                    selection = points.select_enclosed_points(mesh, tolerance=0.0, check_surface=False)
+                    return selection.point_arrays['SelectedPoints'].view(np.bool_)
+
+                model = VoxelModel.from_lattice(voxelize_inside(inside, mesh.bounds, resolution))
+            else:
+                vox = pv.voxelize(mesh, resolution, check_surface=False)
+                model = VoxelModel.from_centres(vox.cell_centers().points, resolution,
+                                                origin=np.array(vox.bounds[::2]))
+            state = zip(['origin', 'spacing', 'dims', 'ijk', 'fraction'], model.__getstate__())
+            return {name: array for name, array in state if array is not None}
+
+        # Parametric shapes are keyed on their parameters, meshes on their placed surface,
+        # which covers the contents of an imported file
+        if implicit:
+            target = dict(shape=shape, centre=np.asarray(params['centre'], dtype=float), **parameters)
+        else:
+            target = dict(vertices=np.asarray(params['vertices']), indices=np.asarray(params['indices']))
+        arrays = self._cached('voxels', voxelize, target=target, resolution=resolution, fractional=fractional)
+        return VoxelModel(arrays['origin'], arrays['spacing'], arrays['dims'], arrays['ijk'], arrays.get('fraction'))
+
+    def coarse_voxel_models(self, factors=(4, 2)):
+        """
+        Voxel models of the stored target at multiples of the voxel resolution, coarsest first.
+
+        They use fractional occupancy so that previews calculated from them keep the
+        target's mass. Levels that would leave the target without voxels are skipped.
+        """
+        resolution = self.target_geometry['voxel']['resolution']
+        models = [self._voxel_model(resolution * factor, fractional=True) for factor in sorted(factors, reverse=True)]
+        return [model for model in models if len(model)]
+
+    @product('terrain', deps=['datum'], files=['path'])
     def generate_terrain(self, method, x_corr_len, y_corr_len, max_elevation, min_elevation, seed, path=None):
         extent = self.scene_properties['datum']
         resolution = self.scene_properties['resolution']
@@ -212,34 +398,49 @@ class Scene:
             print('help')
 
         else:
-            with open('grasimu_project/inputFile', 'r') as file:
-                filedata = file.read()
             shape = extent[0].shape
             dimx = shape[0]
             dimy = shape[1]
 
-            filedata = filedata.replace('method', str(method))
-            filedata = filedata.replace('corr_len', str(x_corr_len) + ',' + str(y_corr_len))
-
-            filedata = filedata.replace('seed', str(seed))
-            filedata = filedata.replace('dimx', str(dimx))
-            filedata = filedata.replace('dimy', str(dimy))
-
-            # Write the file out again
-            with open('randinq', 'w') as file:
-                file.write(filedata)
-
-            mainfunc()  # Generates binary file rando
-            bin2asc()  # converts to a text file
-
-            data = pd.read_csv('randout', sep='\s+', names=['X', 'Y', 'Z'])
-            data = np.reshape([data['Z']], (1024, 1024))
-            data = data[0:dimx, 0:dimy]
-            minimum, maximum = np.min(data), np.max(data)
-
-            m = (max_elevation - min_elevation) / (maximum - minimum)
-            b = min_elevation - m * minimum
-            z_true = m * data + b
+            def random_field():
+                with open(RANDOM_FIELD_INPUT, 'r') as file:
+                    filedata = file.read()
+
+                filedata = filedata.replace('method', str(method))
+                filedata = filedata.replace('corr_len', str(x_corr_len) + ',' + str(y_corr_len))
+
+                filedata = filedata.replace('seed', str(seed))
+                filedata = filedata.replace('dimx', str(dimx))
+                filedata = filedata.replace('dimy', str(dimy))
+
+                # Each field is generated in a directory of its own, so concurrent jobs keep their files apart
+                directory = tempfile.mkdtemp(prefix='randomfield-')
+                with _random_field_lock:
+                    cwd = os.getcwd()
+                    os.chdir(directory)
+                    try:
+                        with open('randinq', 'w') as file:
+                            file.write(filedata)
+
+                        mainfunc()  # Generates binary file rando
+                        bin2asc()  # converts to a text file
+
+                        data = pd.read_csv('randout', sep='\s+', names=['X', 'Y', 'Z'])
+                    finally:
+                        os.chdir(cwd)
+                        shutil.rmtree(directory, ignore_errors=True)
+
+                data = np.reshape([data['Z']], (1024, 1024))
+                data = data[0:dimx, 0:dimy]
+                minimum, maximum = np.min(data), np.max(data)
+
+                m = (max_elevation - min_elevation) / (maximum - minimum)
+                b = min_elevation - m * minimum
+                return dict(elevation=m * data + b)
+
+            # The random field depends only on its parameters and the size of the datum
+            z_true = self._cached('terrain', random_field, method=method, corr_len=(x_corr_len, y_corr_len),
+                                  seed=seed, shape=shape, elevation=(min_elevation, max_elevation))['elevation']
             z_flat = z_true.ravel()
             self.data['elevation']['terrain'] = [self.scene_properties['datum'][0].ravel(),
                                                  self.scene_properties['datum'][1].ravel(),
@@ -252,6 +453,7 @@ class Scene:
         self.sim_params['Max Elevation'] = str(max_elevation) + ' m'
         self.sim_params['Min Elevation'] = str(min_elevation) + ' m'
 
+    @product('dem', deps=['terrain'])
     def generate_dem(self, err):
         signal = self.data['elevation']['terrain'][3]
         error = gaussian_filter(signal, sigma=1)
@@ -281,43 +483,24 @@ class Scene:
 
         self.sim_params['DTM Error'] = '+/- ' + str(err) + ' m'
 
+    @product('terrain_gravity', deps=['dem'])
     def calculate_terrain_gravity(self, rho):
-        for terrain_type in ['terrain', 'dem']:
-            terrain_height = self.data['elevation'][terrain_type][2]
-            dim = self.data['elevation'][terrain_type][2].shape
-            # x = self.scene_properties['datum'][0].ravel()  # added ravel()
-            # y = self.scene_properties['datum'][1].ravel()
-            x = self.data['elevation'][terrain_type][0]
-            y = self.data['elevation'][terrain_type][1]
-            # dim = np.sqrt(len(terrain_height)).astype(int)
-            # terrain_height = terrain_height.reshape(dim, dim)
-            #   CONSTANTS
-            G = 6.67e-11  # Gravitational constant, m^3*kg^-1*s^-2
-            h2 = 0
-            #   INITIALIZE VARIABLES
-            cell_size = self.scene_properties['resolution']
-            del_a = cell_size ** 2
-            total_g = 0
-
-            #   CALCULATION
-            for i in range(len(x)):
-                # for j in range(len(y)):
-                # x_dist = x[i, j] - x
-                # y_dist = y[i, j] - y
-                # z_dist = terrain_height[i, j] - terrain_height
-                x_dist = x[i] - x
-                y_dist = y[i] - y
-                z_dist = terrain_height[i] - terrain_height
-
-                term1 = np.sqrt((np.square(x_dist) + np.square(y_dist) + np.square(z_dist)))
-                term2 = np.sqrt((np.square(x_dist) + np.square(y_dist) + np.square(h2)))
-                del_g = G * rho * del_a * (1 / term2 - 1 / term1)  # Gravitational accl from rectangular prism
-                del_g[np.isnan(del_g)] = 0  # g cannot be analytically obtained for the point being operated on
-                total_g = total_g + del_g
-            # g = (total_g * 1e5)
-            # g_flat = g.ravel()
-            g_flat = (total_g * 1e5)
-            g = g_flat.reshape(dim)
+        # The true terrain and DTM gravity are independent, so they are calculated concurrently
+        cell_size = self.scene_properties['resolution']
+
+        def terrain_gravity():
+            scheduler = StageScheduler()
+            progress = split_progress(self.progress, 2)
+            for terrain_type, part in zip(['terrain', 'dem'], progress):
+                x, y, terrain_height = self.data['elevation'][terrain_type][:3]
+                scheduler.add(terrain_type, terrain_gravity_at, rho, x, y, terrain_height, cell_size,
+                              x, y, terrain_height, progress=part)
+            return scheduler.run()
+
+        surfaces = {terrain_type: self.data['elevation'][terrain_type][:3] for terrain_type in ['terrain', 'dem']}
+        fields = self._cached('terrain_gravity', terrain_gravity, surfaces=surfaces, cell_size=cell_size, rho=rho)
+        for terrain_type, g_flat in fields.items():
+            g = g_flat.reshape(self.data['elevation'][terrain_type][3].shape)
             self.data['perfect_gravity'][terrain_type] = [self.scene_properties['datum'][0].ravel(),
                                                           self.scene_properties['datum'][1].ravel(),
                                                           g_flat,
@@ -326,8 +509,33 @@ class Scene:
                                        self.scene_properties['datum'][1].ravel(),
                                        -self.data['perfect_gravity']['dem'][2],
                                        -self.data['perfect_gravity']['dem'][3]]
+        self.terrain['density'] = rho
         self.sim_params['Background/Terrain Density'] = str(rho) + 'kg/m^3'
 
+    def calculate_station_terrain_gravity(self, x, y, z=0, rho=None, max_distance=None, surfaces=('terrain',)):
+        """
+        Calculates the gravity of the terrain surfaces at the stations x, y only.
+
+        surfaces are 'terrain' for the true terrain and 'dem' for the DTM, whose negative
+        gravity is the terrain correction at the stations. z is the station height above
+        each surface, whose full extent is used as the source. max_distance truncates the
+        sum to cells within that horizontal distance of each station. Returns the gravity
+        at the stations by surface.
+        """
+        if rho is None:
+            rho = self.terrain['density']
+        grid = self.scene_properties['grid']
+        cell_size = self.scene_properties['resolution']
+        z = np.broadcast_to(np.asarray(z, dtype=float), np.shape(x))
+
+        scheduler = StageScheduler()
+        for surface in surfaces:
+            x_cells, y_cells, terrain_height = self.data['elevation'][surface][:3]
+            scheduler.add(surface, terrain_gravity_at, rho, x_cells, y_cells, terrain_height, cell_size,
+                          x, y, grid.sample(terrain_height, x, y) + z, max_distance=max_distance)
+        return scheduler.run()
+
+    @product('analytical', deps=['mesh', 'datum'])
     def calculate_analytical_sphere(self, rho):
         """
         Generates a gravimetry reading in milligals for each (x,y,z) pair,
@@ -369,153 +577,267 @@ class Scene:
                                                g_flat,
                                                g]
 
-    def calculate_target_gravity(self, density_contrast, with_terrain=False, with_noise=False, grav_err=0, gps_err=0):
-        def single_voxel_gravity(drho, x_cen, y_cen, z_cen, spacing, x, y, z):
-            x1 = x_cen - spacing / 2
-            x2 = x_cen + spacing / 2
-            y1 = y_cen - spacing / 2
-            y2 = y_cen + spacing / 2
-            z1 = -1 * (z_cen + spacing / 2)
-            z2 = -1 * (z_cen - spacing / 2)
-
-            dx1 = x1 - x
-            dx2 = x2 - x
-            dy1 = y1 - y
-            dy2 = y2 - y
-            dz1 = z1 + z
-            dz2 = z2 + z
-
-            # Define gravitational constant in mGal m^2/kg
-            G = (6.67408e-11) * 1e5
-
-            R111 = sqrt(p(dx1, 2) + p(dy1, 2) + p(dz1, 2))
-            R112 = sqrt(p(dx2, 2) + p(dy1, 2) + p(dz1, 2))
-            R121 = sqrt(p(dx1, 2) + p(dy2, 2) + p(dz1, 2))
-            R122 = sqrt(p(dx2, 2) + p(dy2, 2) + p(dz1, 2))
-            R211 = sqrt(p(dx1, 2) + p(dy1, 2) + p(dz2, 2))
-            R212 = sqrt(p(dx2, 2) + p(dy1, 2) + p(dz2, 2))
-            R221 = sqrt(p(dx1, 2) + p(dy2, 2) + p(dz2, 2))
-            R222 = sqrt(p(dx2, 2) + p(dy2, 2) + p(dz2, 2))
-
-            g111 = -(m(dz1, arctan(d(m(dx1, dy1), m(dz1, R111)))) - m(dx1, log(R111 + dy1)) - m(dy1,
-                                                                                                log(R111 + dx1)))
-            g112 = (m(dz1, arctan(d(m(dx2, dy1), m(dz1, R112)))) - m(dx2, log(R112 + dy1)) - m(dy1,
-                                                                                               log(R112 + dx2)))
-            g121 = (m(dz1, arctan(d(m(dx1, dy2), m(dz1, R121)))) - m(dx1, log(R121 + dy2)) - m(dy2,
-                                                                                               log(R121 + dx1)))
-            g122 = -(m(dz1, arctan(d(m(dx2, dy2), m(dz1, R122)))) - m(dx2, log(R122 + dy2)) - m(dy2,
-                                                                                                log(R122 + dx2)))
-
-            g211 = (m(dz2, arctan(d(m(dx1, dy1), m(dz2, R211)))) - m(dx1, log(R211 + dy1)) - m(dy1,
-                                                                                               log(R211 + dx1)))
-            g212 = -(m(dz2, arctan(d(m(dx2, dy1), m(dz2, R212)))) - m(dx2, log(R212 + dy1)) - m(dy1,
-                                                                                                log(R212 + dx2)))
-            g221 = -(m(dz2, arctan(d(m(dx1, dy2), m(dz2, R221)))) - m(dx1, log(R221 + dy2)) - m(dy2,
-                                                                                                log(R221 + dx1)))
-            g222 = (m(dz2, arctan(d(m(dx2, dy2), m(dz2, R222)))) - m(dx2, log(R222 + dy2)) - m(dy2,
-                                                                                               log(R222 + dx2)))
-
-            dg = drho * G * (g111 + g112 + g121 + g122 + g211 + g212 + g221 + g222)
-            return dg
+    @product('target_gravity', deps=['voxels', 'datum', 'terrain_gravity'])
+    def calculate_target_gravity(self, density_contrast, with_terrain=False, with_noise=False, grav_err=0, gps_err=0,
+                                 extrapolate=False, ratio=2, voxel_model=None, taylor_tolerance=0.01):
+        """
+        Calculates the gravity of the voxel model at every datum point.
+
+        with_terrain may also be a list of options, e.g. [True, False] for the terrain
+        surface and the flat datum, which are then calculated in one sweep over the voxels.
+
+        voxel_model replaces the stored voxel model for this calculation only, e.g. with
+        one of the coarse_voxel_models for a quick preview.
 
+        With extrapolate=True the field is calculated for the target voxelized with
+        fractional occupancy at the voxel resolution and at ratio times it, and the two are
+        Richardson-extrapolated towards the continuum limit. The estimated error of each
+        station is kept in data['gravity_error'].
+
+        With noise, the field at the GPS-perturbed positions is a Taylor update of the
+        perfect field, which is stored as well. Stations where the second-order term exceeds
+        taylor_tolerance (mGal) are evaluated exactly at their perturbed positions.
+        """
         def add_noise(data, noise, seed=1):
             np.random.seed(seed)
             err = np.random.normal(0, noise / 2, data.shape)
             err_sum = np.round(data + err, 2)
             return err_sum
 
+        def forward(stations, progress=None):
+            def fields():
+                fine_progress, coarse_progress = split_progress(progress, 2) if extrapolate else (progress, None)
+                g = voxel_gravity_multi(model, density_contrast, stations, progress=fine_progress)
+                if not extrapolate:
+                    return {'g{}'.format(i): g_i for i, g_i in enumerate(g)}
+                g_coarse = voxel_gravity_multi(coarse, density_contrast, stations, progress=coarse_progress)
+                extrapolated = [richardson_extrapolate(f, c, ratio, order=2) for f, c in zip(g, g_coarse)]
+                arrays = {'g{}'.format(i): e[0] for i, e in enumerate(extrapolated)}
+                arrays.update({'error{}'.format(i): e[1] for i, e in enumerate(extrapolated)})
+                return arrays
+
+            arrays = self._cached('target_gravity', fields, model=model.__getstate__(), density=density_contrast,
+                                  stations=[[np.asarray(c, dtype=float) for c in s] for s in stations],
+                                  extrapolate=extrapolate, ratio=ratio if extrapolate else None)
+            return ([arrays['g{}'.format(i)] for i in range(len(stations))],
+                    [arrays.get('error{}'.format(i)) for i in range(len(stations))])
+
+        def store(key, terrain_key, g):
+            background = self.data['perfect_gravity']['terrain'][3] if terrain_key == 'full' else 0
+            g_flat = g.ravel() + np.ravel(background)
+            self.data[key][terrain_key] = [self.scene_properties['datum'][0].ravel(),
+                                           self.scene_properties['datum'][1].ravel(),
+                                           g_flat,
+                                           g_flat.reshape(x_loc.shape)]
+
         self.target_parameters['density'] = density_contrast
         self.sim_params['Target Density Contrast'] = str(density_contrast) + ' kg/m^3'
 
-        x_pt = self.target_geometry['voxel']['vertices_filled'][:, 0]
-        y_pt = self.target_geometry['voxel']['vertices_filled'][:, 1]
-        z_pt = self.target_geometry['voxel']['vertices_filled'][:, 2]
+        model = voxel_model if voxel_model is not None else self.target_geometry['voxel']['model']
 
         x_loc = self.scene_properties['datum'][0]
         y_loc = self.scene_properties['datum'][1]
 
-        if not with_terrain:
-            z_loc = self.scene_properties['datum'][2]
-            terrain_key = 'target'
-            background = 0
-        else:
-            z_loc = self.data['elevation']['terrain'][3]
-            terrain_key = 'full'
-            background = self.data['perfect_gravity']['terrain'][3]
+        terrain_options = [with_terrain] if isinstance(with_terrain, bool) else list(with_terrain)
+        terrain_keys = ['full' if option else 'target' for option in terrain_options]
+        z_locs = [np.broadcast_to(self.data['elevation']['terrain'][3] if key == 'full'
+                                  else self.scene_properties['datum'][2], x_loc.shape)
+                  for key in terrain_keys]
+
+        if extrapolate:
+            # The staircase error of filled voxels does not fall smoothly with resolution, so
+            # both levels use fractional occupancy, whose error falls as h^2
+            if model.fraction is None:
+                model = self._voxel_model(model.spacing, fractional=True)
+            coarse = self._voxel_model(model.spacing * ratio, fractional=True)
+
+        fields, errors = forward([(x_loc, y_loc, z_loc) for z_loc in z_locs], progress=self.progress)
+        for terrain_key, g, error in zip(terrain_keys, fields, errors):
+            if extrapolate:
+                self.data['gravity_error'][terrain_key] = [self.scene_properties['datum'][0].ravel(),
+                                                           self.scene_properties['datum'][1].ravel(),
+                                                           error.ravel(),
+                                                           error.reshape(x_loc.shape)]
+            store('perfect_gravity', terrain_key, g)
 
         if with_noise:
-            x_loc = add_noise(x_loc, gps_err)
-            y_loc = add_noise(y_loc, gps_err)
-            noise_key = 'noisy_gravity'
-            k = 1
+            # GPS errors are small against the wavelength of the field, so the field at the
+            # perturbed positions follows from the perfect field and its gradients
+            dx = add_noise(x_loc, gps_err) - x_loc
+            dy = add_noise(y_loc, gps_err) - y_loc
+            shifted = [taylor_shift(g, self.scene_properties['grid'].spacing, dx, dy, tolerance=taylor_tolerance)
+                       for g in fields]
+
+            # Stations where the update is not accurate enough are evaluated exactly, all
+            # options in one sweep
+            fallback = [(x_loc[invalid] + dx[invalid], y_loc[invalid] + dy[invalid], z_loc[invalid])
+                        for (g, invalid), z_loc in zip(shifted, z_locs)]
+            if sum(len(x) for x, y, z in fallback):
+                for (g, invalid), exact in zip(shifted, forward(fallback)[0]):
+                    g[invalid] = exact
+
+            for terrain_key, (g, invalid) in zip(terrain_keys, shifted):
+                store('noisy_gravity', terrain_key, add_noise(g, grav_err))
+
+    def stations(self, session=None):
+        """Survey stations of session as an (n, 3) array of x, y and height above the ground."""
+        return self.measurements['stations'].get(session, np.zeros((0, 3)))
+
+    def add_stations(self, x, y, z=0, snap=False, session=None):
+        """
+        Adds survey stations x, y at height z above the ground to the survey of session.
+
+        Each session's stations are kept server-side in measurements['stations']. Stations
+        outside the scene bounds are dropped and, with snap=True, the rest are moved to the
+        nearest calculation grid point. Stations that duplicate one already in the survey
+        are dropped. Returns the stations added.
+        """
+        x = np.ravel(np.asarray(x, dtype=float))
+        y = np.ravel(np.asarray(y, dtype=float))
+        z = np.broadcast_to(np.asarray(z, dtype=float), x.shape)
+
+        inside = clip_to_bounds(x, y, self.scene_properties['scene_bounds'])
+        x, y, z = x[inside], y[inside], z[inside]
+        if snap:
+            x, y = self.scene_properties['grid'].snap(x, y)
+
+        stations = self.stations(session)
+        combined = np.vstack([stations, np.column_stack([x, y, z])])
+        first = np.unique(combined[:, :2], axis=0, return_index=True)[1]
+        added = combined[np.sort(first[first >= len(stations)])]
+        self.measurements['stations'][session] = np.vstack([stations, added])
+        return added
+
+    def generate_stations(self, layout, z=0, snap=False, session=None, **params):
+        """
+        Adds a layout of survey stations from survey.LAYOUTS: 'grid', 'staggered', 'spiral' or 'line'.
+
+        params are passed to the layout's generator, e.g. bounds, dx and dy for a grid.
+        Returns the stations added.
+        """
+        x, y = LAYOUTS[layout](**params)
+        return self.add_stations(x, y, z=z, snap=snap, session=session)
+
+    def edit_stations(self, edits, session=None):
+        """
+        Moves stations of session: edits maps the index of each station to its new x, y and height.
+
+        The stations are replaced by an edited copy rather than changed in place, as products
+        are, so snapshots and saved states holding the old array keep their values.
+        """
+        stations = self.stations(session).copy()
+        for i, station in edits.items():
+            stations[i] = station
+        self.measurements['stations'][session] = stations
+
+    def clear_stations(self, session=None):
+        self.measurements['stations'].pop(session, None)
+
+    def calculate_station_gravity(self, x, y, z, with_terrain=False, density_contrast=None, voxel_model=None):
+        """
+        Calculates the gravity of the voxel model at the stations x, y only.
+
+        z is the station height above the ground, e.g. 0 for a ground survey or the flight
+        altitude of a drone. Without terrain the ground is the flat datum; with terrain it is
+        the true terrain surface, and the terrain's own gravity at the stations is added once
+        a terrain density has been set by calculate_terrain_gravity.
+        The cost is proportional to stations x voxels, independent of the calculation grid.
+        """
+        model = voxel_model if voxel_model is not None else self.target_geometry['voxel']['model']
+        if density_contrast is None:
+            density_contrast = self.target_parameters['density']
+        grid = self.scene_properties['grid']
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        z = np.broadcast_to(np.asarray(z, dtype=float), x.shape)
+
+        if not with_terrain:
+            return voxel_gravity(model, density_contrast, x, y, z)
+
+        ground = grid.sample(self.data['elevation']['terrain'][3], x, y)
+        if self.terrain['density'] is None:
+            background = 0
         else:
-            noise_key = 'perfect_gravity'
-            k = 0
-
-        g = 0
-        for i in range(0, len(x_pt)):
-            single_point_gravity = single_voxel_gravity(density_contrast,
-                                                        x_pt[i], y_pt[i], z_pt[i],
-                                                        self.target_geometry['voxel']['resolution'],
-                                                        x_loc, y_loc, z_loc)
-            g += single_point_gravity
-        g = [g, add_noise(g, grav_err)]
-
-        g_flat = g[k].ravel() + background
-        g_val = g_flat.reshape(x_loc.shape)
-
-        self.data[noise_key][terrain_key] = [self.scene_properties['datum'][0].ravel(),
-                                             self.scene_properties['datum'][1].ravel(),
-                                             g_flat,
-                                             g_val]
+            background = self.calculate_station_terrain_gravity(x, y, z)['terrain']
+        return voxel_gravity(model, density_contrast, x, y, ground + z) + background
 
+    @product('survey', deps=['target_gravity', 'terrain_gravity'])
     def update_survey(self, x, y, z, grav_err, gps_err):
+        """
+        Simulates the survey measurements at the stations x, y, z.
+
+        The target is evaluated directly at the stations with calculate_station_gravity,
+        so no calculation on the full grid is needed. z is the station height above the
+        ground; stations picked below the ground, e.g. on the target mesh, are placed on it.
+        The terrain correction at the stations, from the DTM gravity once a terrain density
+        is set, is kept in measurements['points'] to be interpolated with the measurements.
+        """
         def add_noise(data, noise, seed=1):
             np.random.seed(seed)
             err = np.random.normal(0, noise / 2, len(data))
             err_sum = np.round(data + err, 2)
             return err_sum
 
-        xx = self.scene_properties['datum'][0]
-        yy = self.scene_properties['datum'][1]
         self.sim_params['Gravimeter Error'] = str(grav_err) + ' mgal'
         self.sim_params['GPS Error'] = str(gps_err) + ' m'
 
-        x_ind = []
-        y_ind = []
-        for i in x:
-            idx = np.where(xx == i)[1][0]
-            x_ind.append(idx)
-        for j in y:
-            idy = np.where(yy == j)[0][0]
-            y_ind.append(idy)
-
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        z = np.maximum(np.asarray(z, dtype=float), 0)
         x_noise = add_noise(x, gps_err)
         y_noise = add_noise(y, gps_err)
 
-        g_test = (self.data['perfect_gravity']['target'][3])
-        g_from_terrain = self.data['perfect_gravity']['full'][3]
-
-        self.measurements['points']['target'] = g_test[y_ind, x_ind]
-        self.measurements['points']['full'] = g_from_terrain[y_ind, x_ind]
-        self.measurements['points']['raw'] = add_noise(g_test[y_ind, x_ind], grav_err)
+        scheduler = StageScheduler()
+        scheduler.add('target', self.calculate_station_gravity, x, y, z, with_terrain=False)
+        scheduler.add('full', self.calculate_station_gravity, x, y, z, with_terrain=True)
+        if self.terrain['density'] is not None:
+            scheduler.add('dem', self.calculate_station_terrain_gravity, x, y, z, surfaces=['dem'])
+        station_gravity = scheduler.run()
+        g_test = station_gravity['target']
+        g_from_terrain = station_gravity['full']
+        terrain_correction = -station_gravity['dem']['dem'] if 'dem' in station_gravity else np.zeros_like(x)
+
+        self.measurements['points']['target'] = g_test
+        self.measurements['points']['full'] = g_from_terrain
+        self.measurements['points']['raw'] = add_noise(g_test, grav_err)
+        self.measurements['points']['terrain_correction'] = terrain_correction
 
         self.measurements['locations']['target'] = [x, y]
         self.measurements['locations']['full'] = [x, y]
         self.measurements['locations']['raw'] = [x_noise, y_noise]
-
+        self.measurements['locations']['terrain_correction'] = [x, y]
+
+    def _station_interpolator(self, key):
+        """Interpolator of the stations of the measurements key, shared by keys measured at the same stations."""
+        x, y = self.measurements['locations'][key]
+        with self._interpolators_lock:
+            for interpolator in self.interpolators.values():
+                if interpolator.matches(x, y):
+                    break
+            else:
+                interpolator = self.interpolators.get(key)
+                if interpolator is None or not interpolator.extend(x, y):
+                    interpolator = StationInterpolator(x, y)
+            self.interpolators[key] = interpolator
+        return interpolator
+
+    @product('interpolation', deps=['survey'])
     def interpolate_survey_pts(self, method):
+        """
+        Grids the survey measurements onto the datum.
+
+        method is 'linear', 'cubic' or 'nearest' for interpolation on the stations'
+        triangulation, or one of the local gridding engines in gridding.LOCAL_METHODS.
+        """
         for key in self.measurements['points'].keys():
-            xx = (self.scene_properties['datum'][0])
-            yy = self.scene_properties['datum'][1]
             vals = self.measurements['points'][key]
-            x = self.measurements['locations'][key][0]
-            y = self.measurements['locations'][key][1]
-
-            interpolated_measurements = interpolate.griddata(points=tuple([x, y]),
-                                                             values=vals,
-                                                             xi=(xx, yy),
-                                                             method=method)
+            if method in LOCAL_METHODS:
+                x, y = self.measurements['locations'][key]
+                interpolated_measurements = local_grid(x, y, vals, self.scene_properties['grid'], method=method)
+            else:
+                interpolator = self._station_interpolator(key)
+                interpolated_measurements = interpolator(vals, self.scene_properties['grid'], method=method)
 
             int_flat = interpolated_measurements.ravel()
 
@@ -524,6 +846,68 @@ class Scene:
                                                 int_flat,
                                                 interpolated_measurements]
 
+    @product('cross_validation', deps=['survey'])
+    def cross_validate(self, method, key='target'):
+        """
+        Leave-one-out cross-validation of an interpolation method on the survey stations.
+
+        Each station of the measurements key is predicted from the others and compared
+        with its value. The errors and summary statistics are kept in
+        measurements['cross_validation'], and the RMS error interpolated between the
+        stations in data['cv_error'].
+        """
+        x, y = (np.ravel(a) for a in self.measurements['locations'][key])
+        values = np.ravel(self.measurements['points'][key])
+        if method in LOCAL_METHODS:
+            predicted = local_leave_one_out(x, y, values, method=method)
+        else:
+            predicted = self._station_interpolator(key).leave_one_out(values, method=method)
+
+        error = predicted - values
+        valid = ~np.isnan(error)
+        stats = {'Stations': len(error),
+                 'Validated': int(valid.sum()),
+                 'RMS Error': np.sqrt(np.mean(error[valid] ** 2)) if valid.any() else np.nan,
+                 'Mean Error': np.mean(error[valid]) if valid.any() else np.nan,
+                 'Max Abs Error': np.max(np.abs(error[valid])) if valid.any() else np.nan}
+
+        grid = self.scene_properties['grid']
+        if valid.sum() >= 3:
+            interpolator = self._station_interpolator(key) if valid.all() else StationInterpolator(x[valid], y[valid])
+            rms = np.sqrt(interpolator(error[valid] ** 2, grid, method='linear'))
+        else:
+            rms = np.full(grid.shape, np.nan)
+
+        self.measurements['cross_validation'] = dict(method=method, error=error, stats=stats)
+        self.data['cv_error'] = [self.scene_properties['datum'][0].ravel(),
+                                 self.scene_properties['datum'][1].ravel(),
+                                 rms.ravel(),
+                                 rms]
+
+    def simulate(self, density_contrast, terrain_density, grav_err=0, gps_err=0, stations=None, method='linear',
+                 voxel_model=None):
+        """
+        Runs every stage from the terrain gravity to the interpolated survey.
+
+        The target gravity over the terrain and over the flat datum follows the terrain
+        gravity, which it is added to, as one sweep over the voxels; the interpolation and
+        the cross-validation run concurrently. The survey stages are skipped without
+        stations, an (n, 3) array of x, y and height above the ground. voxel_model is
+        passed to calculate_target_gravity, e.g. for a quick preview.
+        """
+        scheduler = StageScheduler()
+        scheduler.add('terrain_gravity', self.calculate_terrain_gravity, terrain_density)
+        scheduler.add('target_gravity', self.calculate_target_gravity, density_contrast, with_terrain=[True, False],
+                      with_noise=True, grav_err=grav_err, gps_err=gps_err, voxel_model=voxel_model,
+                      after=['terrain_gravity'])
+        if stations is not None and len(stations) > 2:
+            scheduler.add('survey', self.update_survey, stations[:, 0], stations[:, 1], stations[:, 2],
+                          grav_err, gps_err, after=['target_gravity'])
+            scheduler.add('interpolation', self.interpolate_survey_pts, method, after=['survey'])
+            scheduler.add('cross_validation', self.cross_validate, method, after=['survey'])
+        return scheduler.run()
+
+    @product('corrected', deps=['interpolation', 'target_gravity', 'dem'])
     def apply_corrections(self, free_air=False, terrain=False):
 
         if free_air:
@@ -531,10 +915,13 @@ class Scene:
         else:
             fac = np.zeros_like(self.corrections['free_air'][3])
 
+        # The interpolated survey is corrected with the terrain correction at its stations
         if terrain:
             tc = self.corrections['terrain'][3]
+            station_tc = self.data['interp_gravity']['terrain_correction'][3]
         else:
             tc = np.zeros_like(self.corrections['terrain'][3])
+            station_tc = np.zeros_like(fac)
 
         correction = fac + tc.reshape(fac.shape)
 
@@ -546,5 +933,5 @@ class Scene:
                                                     None,
                                                     None,
                                                     np.add(self.data['interp_gravity']['full'][3],
-                                                           correction,
+                                                           fac + station_tc.reshape(fac.shape),
                                                            where=(self.data['interp_gravity']['full'][3] != None))]
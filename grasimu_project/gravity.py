@@ -0,0 +1,188 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from numpy import sqrt, arctan, log  # import sqrt and arctan function
+from numpy import power as p  # Allows for element-wise power
+from numpy import multiply as m  # Allows element-wise multiplication
+from numpy import divide as d  # Allows for element-wise division
+
+# Part of the key of stored artifacts: bump it whenever a kernel's results change
+ENGINE_VERSION = 1
+
+
+def prism_gravity(drho, x_cen, y_cen, z_cen, spacing, x, y, z):
+    """Vertical gravity in milligals of a cubic prism of density contrast drho at stations x, y, z."""
+    x1 = x_cen - spacing / 2
+    x2 = x_cen + spacing / 2
+    y1 = y_cen - spacing / 2
+    y2 = y_cen + spacing / 2
+    z1 = -1 * (z_cen + spacing / 2)
+    z2 = -1 * (z_cen - spacing / 2)
+
+    dx1 = x1 - x
+    dx2 = x2 - x
+    dy1 = y1 - y
+    dy2 = y2 - y
+    dz1 = z1 + z
+    dz2 = z2 + z
+
+    # Define gravitational constant in mGal m^2/kg
+    G = (6.67408e-11) * 1e5
+
+    R111 = sqrt(p(dx1, 2) + p(dy1, 2) + p(dz1, 2))
+    R112 = sqrt(p(dx2, 2) + p(dy1, 2) + p(dz1, 2))
+    R121 = sqrt(p(dx1, 2) + p(dy2, 2) + p(dz1, 2))
+    R122 = sqrt(p(dx2, 2) + p(dy2, 2) + p(dz1, 2))
+    R211 = sqrt(p(dx1, 2) + p(dy1, 2) + p(dz2, 2))
+    R212 = sqrt(p(dx2, 2) + p(dy1, 2) + p(dz2, 2))
+    R221 = sqrt(p(dx1, 2) + p(dy2, 2) + p(dz2, 2))
+    R222 = sqrt(p(dx2, 2) + p(dy2, 2) + p(dz2, 2))
+
+    g111 = -(m(dz1, arctan(d(m(dx1, dy1), m(dz1, R111)))) - m(dx1, log(R111 + dy1)) - m(dy1,
+                                                                                        log(R111 + dx1)))
+    g112 = (m(dz1, arctan(d(m(dx2, dy1), m(dz1, R112)))) - m(dx2, log(R112 + dy1)) - m(dy1,
+                                                                                       log(R112 + dx2)))
+    g121 = (m(dz1, arctan(d(m(dx1, dy2), m(dz1, R121)))) - m(dx1, log(R121 + dy2)) - m(dy2,
+                                                                                       log(R121 + dx1)))
+    g122 = -(m(dz1, arctan(d(m(dx2, dy2), m(dz1, R122)))) - m(dx2, log(R122 + dy2)) - m(dy2,
+                                                                                        log(R122 + dx2)))
+
+    g211 = (m(dz2, arctan(d(m(dx1, dy1), m(dz2, R211)))) - m(dx1, log(R211 + dy1)) - m(dy1,
+                                                                                       log(R211 + dx1)))
+    g212 = -(m(dz2, arctan(d(m(dx2, dy1), m(dz2, R212)))) - m(dx2, log(R212 + dy1)) - m(dy1,
+                                                                                        log(R212 + dx2)))
+    g221 = -(m(dz2, arctan(d(m(dx1, dy2), m(dz2, R221)))) - m(dx1, log(R221 + dy2)) - m(dy2,
+                                                                                        log(R221 + dx1)))
+    g222 = (m(dz2, arctan(d(m(dx2, dy2), m(dz2, R222)))) - m(dx2, log(R222 + dy2)) - m(dy2,
+                                                                                       log(R222 + dx2)))
+
+    dg = drho * G * (g111 + g112 + g121 + g122 + g211 + g212 + g221 + g222)
+    return dg
+
+
+def voxel_gravity(model, density_contrast, x, y, z, progress=None):
+    """
+    Vertical gravity in milligals of a VoxelModel at stations x, y, z, each voxel weighted by its volume fraction.
+
+    progress, if given, is called with the fraction of voxels done about every percent.
+    """
+    x_pt, y_pt, z_pt = model.centres.T
+
+    # Partially filled voxels contribute in proportion to the volume they enclose
+    fraction = model.weights
+    step = max(1, len(x_pt) // 100)
+
+    g = 0
+    for i in range(0, len(x_pt)):
+        g = g + prism_gravity(density_contrast * fraction[i],
+                              x_pt[i], y_pt[i], z_pt[i],
+                              model.spacing,
+                              x, y, z)
+        if progress is not None and (i + 1) % step == 0:
+            progress((i + 1) / len(x_pt))
+    return g
+
+
+def voxel_gravity_multi(model, density_contrast, stations, progress=None):
+    """
+    Vertical gravity of a VoxelModel at several station sets in a single sweep over the voxels.
+
+    stations is a list of (x, y, z) arrays, e.g. the flat datum, the terrain surface and
+    perturbed positions; one array is returned per set, in its shape. The sets are
+    concatenated, so each voxel's prism terms are set up once for all of them.
+    """
+    shapes = [np.shape(x) for x, y, z in stations]
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    x, y, z = (np.concatenate([np.ravel(np.broadcast_to(s[i], shape)) for s, shape in zip(stations, shapes)])
+               for i in range(3))
+
+    g = np.broadcast_to(voxel_gravity(model, density_contrast, x, y, z, progress=progress), x.shape)
+    return [part.reshape(shape) for part, shape in zip(np.split(g, np.cumsum(sizes)[:-1]), shapes)]
+
+
+def _terrain_kernel(dx, dy, dz, min_distance):
+    """Line-element terrain term of each station-cell pair, zero for cells within min_distance of the station."""
+    horizontal = sqrt(p(dx, 2) + p(dy, 2))
+    slant = sqrt(p(horizontal, 2) + p(dz, 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        term = d(1, horizontal) - d(1, slant)
+    term[horizontal < min_distance] = 0  # g cannot be analytically obtained for the station's own cell
+    return term
+
+
+def terrain_gravity_at(rho, x_cells, y_cells, z_cells, cell_size, x, y, z, max_distance=None, chunk_size=2 ** 22,
+                       progress=None):
+    """
+    Terrain gravity in milligals at stations x, y, z of a DEM with cells at x_cells, y_cells, z_cells.
+
+    Each cell is a line element of area cell_size ** 2, as in Scene.calculate_terrain_gravity,
+    and cells within half a cell of a station are skipped. The cost is stations x cells, or
+    stations x cells within max_distance when the sum is truncated to a zone around each
+    station, found with a KD-tree. chunk_size bounds the number of pairs held in memory.
+    progress, if given, is called with the fraction of pairs done after each chunk.
+    """
+    G = 6.67e-11  # Gravitational constant, m^3*kg^-1*s^-2
+    x_cells, y_cells, z_cells = (np.ravel(a).astype(float) for a in (x_cells, y_cells, z_cells))
+    x, y, z = (np.ravel(a).astype(float) for a in (x, y, z))
+    min_distance = cell_size / 2
+
+    total_g = np.zeros(len(x))
+    if max_distance is None:
+        rows = max(1, chunk_size // len(x_cells))
+        for start in range(0, len(x), rows):
+            s = slice(start, start + rows)
+            term = _terrain_kernel(x_cells - x[s, None],
+                                   y_cells - y[s, None],
+                                   z_cells - z[s, None],
+                                   min_distance)
+            total_g[s] = term.sum(axis=1)
+            if progress is not None:
+                progress(min(start + rows, len(x)) / len(x))
+    else:
+        tree = cKDTree(np.column_stack([x_cells, y_cells]))
+        zones = tree.query_ball_point(np.column_stack([x, y]), max_distance)
+        counts = np.fromiter((len(zone) for zone in zones), dtype=int, count=len(x))
+        if counts.sum():
+            station = np.repeat(np.arange(len(x)), counts)
+            cell = np.concatenate([zone for zone in zones if zone]).astype(int)
+            for start in range(0, len(cell), chunk_size):
+                s = slice(start, start + chunk_size)
+                term = _terrain_kernel(x_cells[cell[s]] - x[station[s]],
+                                       y_cells[cell[s]] - y[station[s]],
+                                       z_cells[cell[s]] - z[station[s]],
+                                       min_distance)
+                total_g += np.bincount(station[s], weights=term, minlength=len(x))
+                if progress is not None:
+                    progress(min(start + chunk_size, len(cell)) / len(cell))
+
+    return G * rho * cell_size ** 2 * total_g * 1e5
+
+
+def taylor_shift(g, spacing, dx, dy, tolerance=0.01):
+    """
+    Shifts a gridded field g to stations displaced by dx, dy with a first-order Taylor update.
+
+    g is a 2D array with rows along y and spacing (x, y) between grid points. The
+    second-order term estimates the error of the update at each station; the returned mask
+    marks stations where it exceeds tolerance (in the units of g) and an exact evaluation
+    is needed.
+    """
+    if min(g.shape) < 3:
+        return g.copy(), np.ones(g.shape, dtype=bool)
+    g_y, g_x = np.gradient(g, spacing[1], spacing[0])
+    g_xy, g_xx = np.gradient(g_x, spacing[1], spacing[0])
+    g_yy = np.gradient(g_y, spacing[1], axis=0)
+
+    shifted = g + g_x * dx + g_y * dy
+    second_order = 0.5 * (g_xx * dx ** 2 + 2 * g_xy * dx * dy + g_yy * dy ** 2)
+    return shifted, np.abs(second_order) > tolerance
+
+
+def richardson_extrapolate(fine, coarse, ratio, order):
+    """
+    Extrapolates two solutions at resolutions h and ratio * h towards h -> 0.
+
+    Assumes the discretization error falls as h**order. Returns the extrapolated field
+    and an estimate of the remaining error in the fine solution at each station.
+    """
+    correction = (fine - coarse) / (ratio ** order - 1)
+    return fine + correction, np.abs(correction)
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+
+def _biharmonic(r, spacing):
+    """Green's function of the biharmonic (minimum curvature) spline, r^2 (ln r - 1)."""
+    r = r / spacing
+    with np.errstate(divide='ignore', invalid='ignore'):
+        green = np.square(r) * (np.log(r) - 1)
+    green[r == 0] = 0
+    return green
+
+
+def _multiquadric(r, spacing):
+    return np.sqrt(np.square(r / spacing) + 1)
+
+
+def _exponential_covariance(r, spacing):
+    """Exponential covariance of ordinary kriging, with a range of four station spacings."""
+    return np.exp(-r / (4 * spacing))
+
+
+def _point_source(r, spacing):
+    """Vertical attraction at the surface of unit point sources buried 1.5 station spacings deep."""
+    depth = 1.5 * spacing
+    return depth / np.power(np.square(r) + depth ** 2, 1.5)
+
+
+# Kernel of each engine and the degree of the polynomial drift solved with it
+LOCAL_METHODS = dict(mincurv=(_biharmonic, 1),
+                     rbf=(_multiquadric, 0),
+                     kriging=(_exponential_covariance, 0),
+                     eqs=(_point_source, 1))
+
+
+def _drift(xy, degree):
+    if degree == 0:
+        return np.ones((len(xy), 1))
+    return np.column_stack([np.ones(len(xy)), xy])
+
+
+def _solve_local(kernel, degree, xy, values, xi, spacing):
+    """Fits the kernel to the stations xy and evaluates the fit at xi, coordinates relative to the tile."""
+    n = len(xy)
+    p = _drift(xy, degree)
+    system = np.zeros((n + p.shape[1], n + p.shape[1]))
+    system[:n, :n] = kernel(cdist(xy, xy), spacing)
+    system[:n, :n] += 1e-10 * np.eye(n)
+    system[:n, n:] = p
+    system[n:, :n] = p.T
+    rhs = np.concatenate([values, np.zeros(p.shape[1])])
+    try:
+        coefficients = np.linalg.solve(system, rhs)
+    except np.linalg.LinAlgError:
+        coefficients = np.linalg.lstsq(system, rhs, rcond=None)[0]
+    return kernel(cdist(xi, xy), spacing) @ coefficients[:n] + _drift(xi, degree) @ coefficients[n:]
+
+
+def local_grid(x, y, values, grid, method='mincurv', neighbours=16, max_points=256, tile_size=None, workers=None):
+    """
+    Grids scattered station values onto a RegularGrid with a local interpolation engine.
+
+    method is one of LOCAL_METHODS: 'mincurv' (minimum curvature biharmonic spline), 'rbf'
+    (multiquadric radial basis functions), 'kriging' (ordinary kriging with an exponential
+    covariance) or 'eqs' (equivalent point sources). The grid is split into tiles of
+    tile_size x tile_size points within the bounding box of the stations, by default
+    sized to hold about a quarter of max_points stations. Each tile is fitted to at most
+    max_points stations near it, found with a KD-tree, so memory is bounded regardless of
+    the number of stations. Tiles are solved in parallel over workers threads. Points
+    outside the bounding box are NaN.
+    """
+    kernel, degree = LOCAL_METHODS[method]
+    xy = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+    values = np.ravel(values).astype(float)
+    tree = cKDTree(xy)
+    neighbours = min(neighbours, len(xy))
+    max_points = min(max_points, len(xy))
+
+    # Kernel length scale: the median distance between neighbouring stations
+    spacing = np.median(tree.query(xy, k=2)[0][:, 1]) if len(xy) > 1 else 1.0
+    spacing = spacing if spacing > 0 else 1.0
+
+    result = np.full(grid.shape, np.nan)
+    (x_min, y_min), (x_max, y_max) = xy.min(axis=0), xy.max(axis=0)
+    row_min, col_min = grid.fractional_index(x_min, y_min)
+    row_max, col_max = grid.fractional_index(x_max, y_max)
+    rows = np.arange(max(int(np.ceil(min(row_min, row_max))), 0),
+                     min(int(np.floor(max(row_min, row_max))) + 1, grid.shape[0]))
+    cols = np.arange(max(int(np.ceil(min(col_min, col_max))), 0),
+                     min(int(np.floor(max(col_min, col_max))) + 1, grid.shape[1]))
+
+    if tile_size is None:
+        area = max((x_max - x_min) * (y_max - y_min), spacing ** 2)
+        side = np.sqrt(area * max_points / 4 / len(xy))
+        tile_size = int(np.clip(side / np.min(grid.spacing), 4, 64))
+
+    def solve_tile(tile_rows, tile_cols):
+        xx, yy = np.meshgrid(grid.x[tile_cols], grid.y[tile_rows])
+        xi = np.column_stack([xx.ravel(), yy.ravel()])
+        centre = xi.mean(axis=0)
+        half_diagonal = np.hypot(*(xi.max(axis=0) - xi.min(axis=0))) / 2
+
+        # The tile's neighbourhood covers the neighbours of every point in it
+        reach = np.atleast_1d(tree.query(centre, k=neighbours)[0])[-1] + half_diagonal
+        distance, index = tree.query(centre, k=max_points, distance_upper_bound=reach)
+        index = np.atleast_1d(index)[np.isfinite(np.atleast_1d(distance))]
+
+        fit = _solve_local(kernel, degree, xy[index] - centre, values[index], xi - centre, spacing)
+        result[np.ix_(tile_rows, tile_cols)] = fit.reshape(xx.shape)
+
+    tiles = [(rows[i:i + tile_size], cols[j:j + tile_size])
+             for i in range(0, len(rows), tile_size)
+             for j in range(0, len(cols), tile_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda tile: solve_tile(*tile), tiles))
+    return result
+
+
+def local_leave_one_out(x, y, values, method='mincurv', neighbours=16):
+    """Predicts each station's value from its nearest neighbours with a local engine, leaving the station out."""
+    kernel, degree = LOCAL_METHODS[method]
+    xy = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+    values = np.ravel(values).astype(float)
+    predicted = np.full(len(xy), np.nan)
+    if len(xy) < 2:
+        return predicted
+
+    tree = cKDTree(xy)
+    spacing = np.median(tree.query(xy, k=2)[0][:, 1])
+    spacing = spacing if spacing > 0 else 1.0
+    index = tree.query(xy, k=min(neighbours + 1, len(xy)))[1]
+
+    for i, station in enumerate(index):
+        others = station[station != i]
+        predicted[i] = _solve_local(kernel, degree, xy[others] - xy[i], values[others], np.zeros((1, 2)), spacing)[0]
+    return predicted
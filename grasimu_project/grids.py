@@ -0,0 +1,277 @@
+import threading
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy.spatial import Delaunay, cKDTree
+try:
+    from scipy.spatial import QhullError
+except ImportError:  # scipy < 1.8
+    from scipy.spatial.qhull import QhullError
+
+# Spline order used by map_coordinates for each sampling method
+SAMPLING_ORDERS = dict(nearest=0, bilinear=1, bicubic=3)
+
+
+class RegularGrid:
+    """
+    Regular 2D grid of calculation points, as laid out by Scene.create_datum.
+
+    Products on the grid are 2D arrays of shape (ny, nx) with rows along y, matching
+    np.meshgrid(x, y). Coordinates are mapped to indices arithmetically rather than by
+    searching the grid, so lookups and sampling are vectorized over any number of stations.
+    """
+
+    def __init__(self, origin, spacing, shape):
+        self.origin = np.asarray(origin, dtype=float)
+        self.spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (2,)).copy()
+        self.shape = tuple(int(n) for n in shape)
+
+    @classmethod
+    def from_mesh(cls, xx, yy, spacing=1.0):
+        """Builds the grid of the meshgrid arrays xx, yy; spacing is used along axes with a single point."""
+        dx = xx[0, 1] - xx[0, 0] if xx.shape[1] > 1 else spacing
+        dy = yy[1, 0] - yy[0, 0] if yy.shape[0] > 1 else spacing
+        return cls((xx[0, 0], yy[0, 0]), (dx, dy), xx.shape)
+
+    def __repr__(self):
+        return 'RegularGrid(origin={}, spacing={}, shape={})'.format(self.origin.tolist(),
+                                                                    self.spacing.tolist(),
+                                                                    self.shape)
+
+    @property
+    def x(self):
+        return self.origin[0] + np.arange(self.shape[1]) * self.spacing[0]
+
+    @property
+    def y(self):
+        return self.origin[1] + np.arange(self.shape[0]) * self.spacing[1]
+
+    @property
+    def bounds(self):
+        """[x_min, y_min, x_max, y_max], the same layout as scene_bounds."""
+        return [self.x[0], self.y[0], self.x[-1], self.y[-1]]
+
+    def mesh(self):
+        return np.meshgrid(self.x, self.y)
+
+    def fractional_index(self, x, y):
+        """Row and column positions of points x, y in units of grid cells."""
+        col = (np.asarray(x, dtype=float) - self.origin[0]) / self.spacing[0]
+        row = (np.asarray(y, dtype=float) - self.origin[1]) / self.spacing[1]
+        return row, col
+
+    def contains(self, x, y):
+        row, col = self.fractional_index(x, y)
+        return (row >= -0.5) & (row <= self.shape[0] - 0.5) & (col >= -0.5) & (col <= self.shape[1] - 0.5)
+
+    def index(self, x, y):
+        """Row and column of the grid points nearest to x, y, clipped to the grid."""
+        row, col = self.fractional_index(x, y)
+        row = np.clip(np.rint(row), 0, self.shape[0] - 1).astype(int)
+        col = np.clip(np.rint(col), 0, self.shape[1] - 1).astype(int)
+        return row, col
+
+    def snap(self, x, y):
+        """Coordinates of the grid points nearest to x, y."""
+        row, col = self.index(x, y)
+        return self.origin[0] + col * self.spacing[0], self.origin[1] + row * self.spacing[1]
+
+    def sample(self, values, x, y, method='bilinear'):
+        """
+        Samples a product on the grid at arbitrary points x, y.
+
+        method is 'nearest', 'bilinear' or 'bicubic' (a cubic spline through the grid
+        values). Points on grid nodes return the node values exactly; points outside the
+        grid take the value of the nearest edge.
+        """
+        row, col = self.fractional_index(x, y)
+        values = np.asarray(values, dtype=float).reshape(self.shape)
+        return map_coordinates(values, [np.ravel(row), np.ravel(col)],
+                               order=SAMPLING_ORDERS[method], mode='nearest').reshape(np.shape(row))
+
+
+class StationInterpolator:
+    """
+    Interpolates values at scattered survey stations onto a RegularGrid.
+
+    The Delaunay triangulation of the stations is built once and shared by every product
+    measured at them, and is updated incrementally as stations are added. Linear
+    interpolation reuses the barycentric weights of the grid points, cubic interpolation
+    builds a Clough-Tocher interpolant on the same triangulation, and nearest uses a
+    KD-tree. Linear and cubic results are only evaluated inside the bounding box of the
+    stations, in tiles of tile_size grid points; the rest of the grid is NaN, as with
+    scipy.interpolate.griddata.
+    """
+
+    def __init__(self, x, y, tile_size=2 ** 16):
+        self.points = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+        self.tile_size = tile_size
+        self.triangulation = Delaunay(self.points, incremental=True)
+        self._tree = None
+        self._weights = None
+        # Products may be interpolated and cross-validated concurrently, so extending the
+        # stations and building the cached weights and tree happen one thread at a time
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # The incremental triangulation holds a live Qhull handle, so it is rebuilt on loading
+        state = self.__dict__.copy()
+        for name in ['triangulation', '_tree', '_weights', '_lock']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.triangulation = Delaunay(self.points, incremental=True)
+        self._tree = None
+        self._weights = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.points)
+
+    def matches(self, x, y):
+        """True if x, y are exactly the stations of this interpolator."""
+        points = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+        return np.array_equal(points, self.points)
+
+    def extend(self, x, y):
+        """
+        Adds the stations x, y that are new, if the current stations are the first of them.
+
+        Returns False, leaving the interpolator unchanged, if x, y do not start with the
+        current stations and a new interpolator is needed.
+        """
+        points = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+        with self._lock:
+            n = len(self)
+            if len(points) < n or not np.array_equal(points[:n], self.points):
+                return False
+            if len(points) > n:
+                self.add_points(points[n:, 0], points[n:, 1])
+        return True
+
+    def add_points(self, x, y):
+        points = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+        self.triangulation.add_points(points)
+        self.points = np.vstack([self.points, points])
+        self._tree = None
+        self._weights = None
+
+    def window(self, grid):
+        """Row and column slices of the grid points inside the bounding box of the stations."""
+        (x_min, y_min), (x_max, y_max) = self.points.min(axis=0), self.points.max(axis=0)
+        row_min, col_min = grid.fractional_index(x_min, y_min)
+        row_max, col_max = grid.fractional_index(x_max, y_max)
+        row_min, row_max = sorted([row_min, row_max])
+        col_min, col_max = sorted([col_min, col_max])
+        rows = slice(max(int(np.ceil(row_min)), 0), min(int(np.floor(row_max)) + 1, grid.shape[0]))
+        cols = slice(max(int(np.ceil(col_min)), 0), min(int(np.floor(col_max)) + 1, grid.shape[1]))
+        return rows, cols
+
+    def _tiles(self, grid):
+        """Yields the flat indices and coordinates of the grid points in the window, a tile at a time."""
+        rows, cols = self.window(grid)
+        row, col = np.mgrid[rows, cols]
+        flat = np.ravel_multi_index((row.ravel(), col.ravel()), grid.shape)
+        xi = np.column_stack([grid.x[col.ravel()], grid.y[row.ravel()]])
+        for start in range(0, len(flat), self.tile_size):
+            yield flat[start:start + self.tile_size], xi[start:start + self.tile_size]
+
+    def _nearest_tree(self):
+        with self._lock:
+            if self._tree is None:
+                self._tree = cKDTree(self.points)
+            return self._tree
+
+    def _linear_weights(self, grid):
+        """Station indices and barycentric weights of the grid points in the window, cached per grid."""
+        key = (tuple(grid.origin), tuple(grid.spacing), grid.shape)
+        with self._lock:
+            if self._weights is None or self._weights[0] != key:
+                flat, vertices, weights = [], [], []
+                for tile, xi in self._tiles(grid):
+                    simplex = self.triangulation.find_simplex(xi)
+                    inside = simplex >= 0
+                    transform = self.triangulation.transform[simplex[inside]]
+                    b = np.einsum('nij,nj->ni', transform[:, :2], xi[inside] - transform[:, 2])
+                    flat.append(tile[inside])
+                    vertices.append(self.triangulation.simplices[simplex[inside]])
+                    weights.append(np.column_stack([b, 1 - b.sum(axis=1)]))
+                self._weights = (key,
+                                 np.concatenate(flat) if flat else np.zeros(0, dtype=int),
+                                 np.concatenate(vertices) if vertices else np.zeros((0, 3), dtype=int),
+                                 np.concatenate(weights) if weights else np.zeros((0, 3)))
+            return self._weights[1:]
+
+    def __call__(self, values, grid, method='linear'):
+        """Interpolates the station values onto grid with method 'linear', 'cubic' or 'nearest'."""
+        values = np.ravel(values).astype(float)
+        result = np.full(grid.shape, np.nan)
+        out = result.reshape(-1)
+
+        if method == 'nearest':
+            tree = self._nearest_tree()
+            xx, yy = grid.mesh()
+            xi = np.column_stack([xx.ravel(), yy.ravel()])
+            for start in range(0, len(xi), self.tile_size):
+                out[start:start + self.tile_size] = values[tree.query(xi[start:start + self.tile_size])[1]]
+        elif method == 'linear':
+            flat, vertices, weights = self._linear_weights(grid)
+            out[flat] = (values[vertices] * weights).sum(axis=1)
+        elif method == 'cubic':
+            with self._lock:
+                interpolant = CloughTocher2DInterpolator(self.triangulation, values)
+                tiles = list(self._tiles(grid))
+            for tile, xi in tiles:
+                out[tile] = interpolant(xi)
+        else:
+            raise ValueError('Unknown interpolation method: {}'.format(method))
+        return result
+
+    def leave_one_out(self, values, method='linear'):
+        """
+        Predicts each station's value from the other stations, for cross-validation.
+
+        Removing a station only changes the triangulation inside its ring of neighbours, so
+        linear predictions retriangulate just that ring and equal a full leave-one-out
+        griddata up to the choice among co-circular triangulations: on regular layouts,
+        whose Delaunay triangulation is not unique, the two may differ. Cubic predictions use the stations within two rings, and nearest takes
+        the value of the second nearest station. Stations on the hull of the survey, which
+        cannot be interpolated without themselves, are NaN except for nearest.
+        """
+        values = np.ravel(values).astype(float)
+        predicted = np.full(len(self), np.nan)
+
+        if method == 'nearest':
+            if len(self) > 1:
+                predicted = values[self._nearest_tree().query(self.points, k=2)[1][:, 1]]
+            return predicted
+        if method not in ('linear', 'cubic'):
+            raise ValueError('Unknown interpolation method: {}'.format(method))
+
+        with self._lock:
+            points = self.points
+            indptr, indices = self.triangulation.vertex_neighbor_vertices
+        predicted = np.full(len(points), np.nan)
+        for i, point in enumerate(points):
+            ring = indices[indptr[i]:indptr[i + 1]]
+            if method == 'cubic':
+                ring = np.concatenate([indices[indptr[j]:indptr[j + 1]] for j in ring] + [ring])
+                ring = np.unique(ring[ring != i])
+            if len(ring) < 3:
+                continue
+            try:
+                local = Delaunay(points[ring])
+            except QhullError:
+                continue
+            if method == 'linear':
+                simplex = local.find_simplex(point)
+                if simplex < 0:
+                    continue
+                b = local.transform[simplex, :2] @ (point - local.transform[simplex, 2])
+                predicted[i] = values[ring[local.simplices[simplex]]] @ np.append(b, 1 - b.sum())
+            else:
+                predicted[i] = CloughTocher2DInterpolator(local, values[ring])(point[None])[0]
+        return predicted
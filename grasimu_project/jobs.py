@@ -0,0 +1,264 @@
+import multiprocessing
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+from .pipeline import DEPENDENCIES, PRODUCT_FIELDS, descendants
+from .state import StateConflict
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's calculation, at its next progress report, once the job is cancelled."""
+
+
+class JobStale(Exception):
+    """Raised on writing back the results of a job whose upstream products changed while it ran."""
+
+
+def split_progress(progress, parts):
+    """
+    Progress callbacks for parts equal shares of a calculation, e.g. kernels run concurrently.
+
+    Each is passed the fraction done of its share, and progress the fraction done of the
+    whole. With progress None, so are all the parts.
+    """
+    if progress is None:
+        return [None] * parts
+    done = [0.0] * parts
+    lock = threading.Lock()
+
+    def part(i):
+        def report(fraction):
+            with lock:
+                done[i] = fraction
+                total = sum(done) / parts
+            progress(total)
+        return report
+
+    return [part(i) for i in range(parts)]
+
+
+def _entries(scene):
+    """Ids of the values in the product dicts of scene, by path."""
+    entries = dict()
+    pending = [((field,), getattr(scene, field)) for field in PRODUCT_FIELDS]
+    while pending:
+        path, values = pending.pop()
+        for key, value in values.items():
+            entries[path + (key,)] = id(value)
+            if isinstance(value, dict):
+                pending.append((path + (key,), value))
+    return entries
+
+
+def _changes(scene, before):
+    """Paths and values of the product dict entries of scene that are not the objects they were before."""
+    changes = []
+    pending = [((field,), getattr(scene, field)) for field in PRODUCT_FIELDS]
+    while pending:
+        path, values = pending.pop()
+        for key, value in values.items():
+            if before.get(path + (key,)) != id(value):
+                changes.append((path + (key,), value))
+            elif isinstance(value, dict):
+                pending.append((path + (key,), value))
+    return changes
+
+
+def _calculated(scene, before):
+    """
+    Products scene calculated since its memo entries were before, with their results and
+    arguments, upstream products first.
+    """
+    entries = scene.products.entries()
+    names = [name for name, entry in entries.items() if before.get(name) is not entry]
+    names.sort(key=lambda name: sum(name in descendants(other) for other in DEPENDENCIES))
+    return [(name, entries[name][1], entries[name][2]) for name in names]
+
+
+def _run(job_id, data, method, args, kwargs, status):
+    """
+    Runs scene.method in a worker process on the pickled Scene data.
+
+    Products are replaced rather than updated in place, so the entries the method wrote
+    are those that are new objects afterwards; only they are sent back, with the products
+    calculated on the way, e.g. every stage of a pipeline.
+    """
+    # Cancelled while queued, possibly by another process of the server
+    if status.get((job_id, 'cancel')):
+        raise JobCancelled(job_id)
+    scene = pickle.loads(data)
+
+    def report(fraction):
+        if status.get((job_id, 'cancel')):
+            raise JobCancelled(job_id)
+        status[(job_id, 'progress')] = fraction
+
+    status[(job_id, 'state')] = 'running'
+    scene.progress = report
+    before = _entries(scene)
+    memo = scene.products.entries()
+    result = getattr(scene, method)(*args, **kwargs)
+    return result, _changes(scene, before), _calculated(scene, memo)
+
+
+def apply_changes(scene, changes, products, versions=None):
+    """
+    Writes the product entries and products calculated by a job into scene, as if the job's
+    method had run there.
+
+    versions are the product versions of scene when the job was submitted. If a product
+    that one of the calculated products depends on has changed since, the results are out
+    of date: they are dropped and JobStale is raised, rather than written and memoized as
+    current.
+    """
+    with scene.products.computing.shared():
+        if versions is not None:
+            changed = [name for name, _, _ in products
+                       if any(scene.products.version(dep) != versions.get(dep, 0) for dep in DEPENDENCIES[name])]
+            if changed:
+                raise JobStale('The inputs of {} changed while the job ran'.format(', '.join(changed)))
+        for path, value in changes:
+            target = getattr(scene, path[0])
+            for step in path[1:-1]:
+                target = target[step]
+            target[path[-1]] = value
+        # Upstream products first, so each is memoized with the versions of those it follows
+        for name, result, arguments in products:
+            scene.products.store(name, scene.products.key(name, *arguments), result, arguments=arguments)
+    scene.publish()
+
+
+class JobQueue:
+    """
+    Runs long Scene calculations in worker processes, so they do not block the web server.
+
+    A job runs a copy of the Scene, sent to the worker pickled, and its results are written
+    back into the Scene when it finishes. Jobs are identified by the id returned by submit,
+    and report their state ('queued', 'running', 'done', 'failed', 'cancelled' or 'stale',
+    when the products it depends on were recalculated while it ran) and the fraction of
+    their calculation done, as reported by the kernels.
+
+    status is the dict-like store of the jobs' states and progress, e.g. a SharedDict of a
+    SceneState, so that the other processes of the server can report and cancel them too.
+    By default it is a dict of a multiprocessing manager, private to this process.
+
+    scenes, e.g. SceneRegistry.current, returns the latest Scene of a session by name. The
+    results of a job are written into that Scene rather than the copy it was submitted
+    with, which another process may have replaced while the job ran; if the Scene is saved
+    by another process while the results are written, they are written again into its
+    new copy, up to retries times.
+    """
+
+    def __init__(self, max_workers=None, status=None, scenes=None, retries=5):
+        self.max_workers = max_workers
+        self.scenes = scenes
+        self.retries = retries
+        self._executor = None
+        self._manager = None
+        self._status = status
+        self._jobs = dict()
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Spawned workers import the main module again, so the processes are only started
+        # once a job is submitted rather than when the queue is created there
+        if self._executor is None:
+            # Worker processes are spawned rather than forked from the threaded server
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            if self._status is None:
+                self._manager = context.Manager()
+                self._status = self._manager.dict()
+
+    def submit(self, scene, method, *args, **kwargs):
+        """Queues scene.method(*args, **kwargs) and returns the id of the job."""
+        job_id = uuid.uuid4().hex
+        # The Scene is copied between calculations, so the job starts from consistent products,
+        # whose versions are those its results are checked against when it finishes
+        with scene.products.computing.exclusive():
+            data = pickle.dumps(scene, protocol=pickle.HIGHEST_PROTOCOL)
+            versions = dict(scene.products.versions)
+
+        with self._lock:
+            self._start()
+            self._status[(job_id, 'state')] = 'queued'
+            future = self._executor.submit(_run, job_id, data, method, args, kwargs, self._status)
+            self._jobs[job_id] = future
+
+        def finish(future):
+            try:
+                _, changes, products = future.result()
+                # A job cancelled as it finished must not overwrite the results that replaced it
+                if self._status.get((job_id, 'cancel')):
+                    raise JobCancelled(job_id)
+                self._apply(scene, method, changes, products, versions)
+                state, error = 'done', None
+            except (CancelledError, JobCancelled):
+                state, error = 'cancelled', None
+            except JobStale:
+                state, error = 'stale', None
+            except Exception as e:
+                state, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+            self._status[(job_id, 'error')] = error
+            self._status[(job_id, 'state')] = state
+
+        future.add_done_callback(finish)
+        return job_id
+
+    def _apply(self, scene, method, changes, products, versions):
+        for attempt in range(self.retries):
+            target = scene if self.scenes is None else self.scenes(scene.name)
+            apply_changes(target, changes, products, versions)
+            # A copy whose save conflicted is out of date, and the next attempt gets its successor
+            if target.state is None or target.state_version == target.state.version(target.name):
+                return
+        raise StateConflict('Scene {} kept changing while the results of {} were written'.format(scene.name, method))
+
+    def status(self, job_id):
+        """State, fraction done and error message of a job."""
+        state = 'unknown' if self._status is None else self._status.get((job_id, 'state'), 'unknown')
+        if state == 'unknown':
+            return dict(state=state, progress=0.0, error=None)
+        progress = 1.0 if state == 'done' else self._status.get((job_id, 'progress'), 0.0)
+        return dict(state=state, progress=progress, error=self._status.get((job_id, 'error')))
+
+    def done(self, job_id):
+        return self.status(job_id)['state'] in ('done', 'failed', 'cancelled', 'stale', 'unknown')
+
+    def wait(self, job_id, timeout=None):
+        """Waits for a job to finish and returns its status."""
+        with self._lock:
+            future = self._jobs[job_id]
+        try:
+            future.exception(timeout=timeout)
+        except CancelledError:
+            pass
+        # The results are written back by a callback that may still be running
+        while not self.done(job_id):
+            time.sleep(0.01)
+        return self.status(job_id)
+
+    def cancel(self, job_id):
+        """Cancels a job: a queued job does not start, and a running one stops at its next progress report."""
+        with self._lock:
+            future = self._jobs.get(job_id)
+        # A job submitted by another process is stopped through the status store
+        if (future is None or not future.cancel()) and self._status is not None:
+            self._status[(job_id, 'cancel')] = True
+
+    def forget(self, job_id):
+        """Drops the record of a finished job."""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        if self._status is not None:
+            for key in ['state', 'progress', 'error', 'cancel']:
+                self._status.pop((job_id, key), None)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
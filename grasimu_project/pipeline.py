@@ -0,0 +1,272 @@
+import functools
+import hashlib
+import inspect
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+# Direct dependencies of each product, filled in by the product decorator
+DEPENDENCIES = dict()
+# Signature and file path arguments of the products that read files
+FILE_ARGUMENTS = dict()
+
+# Scene attributes holding its products
+PRODUCT_FIELDS = ('scene_properties', 'target_geometry', 'terrain', 'corrections', 'data', 'measurements',
+                  'sim_params')
+
+
+def fingerprint(value):
+    """Hashable summary of a product's argument; arrays are summarized by a digest of their contents."""
+    if isinstance(value, np.ndarray):
+        return 'array', value.shape, str(value.dtype), hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__, tuple(fingerprint(v) for v in value)
+    if isinstance(value, dict):
+        return 'dict', tuple(sorted((k, fingerprint(v)) for k, v in value.items()))
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic)):
+        return value
+    # Other objects, e.g. a VoxelModel, only match themselves; the ProductGraph keeps the
+    # arguments of each product's last call alive, so their ids are not reused meanwhile
+    return 'object', id(value)
+
+
+def file_stamp(path):
+    """Modification time and size of the file at path, or None if there is none."""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def descendants(name):
+    """Products that depend on name, directly or through other products."""
+    found = set()
+    pending = [name]
+    while pending:
+        current = pending.pop()
+        for product, deps in DEPENDENCIES.items():
+            if current in deps and product not in found:
+                found.add(product)
+                pending.append(product)
+    return found
+
+
+def freeze(value):
+    """
+    Copy of the dicts and lists of value holding read-only views of its arrays.
+
+    Products are replaced rather than updated in place when they are recalculated, so the
+    copy keeps the values of the moment it was made without copying any array data.
+    """
+    if isinstance(value, np.ndarray):
+        view = value.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(value, dict):
+        return {k: freeze(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [freeze(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class SharedLock:
+    """
+    Reader/writer lock: any number of shared holders at a time, or one exclusive holder.
+
+    Shared holders only wait while the lock is held exclusively, so a thread may take it
+    shared again while it already holds it.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._exclusive = False
+
+    def acquire_shared(self):
+        with self._condition:
+            while self._exclusive:
+                self._condition.wait()
+            self._shared += 1
+
+    def release_shared(self):
+        with self._condition:
+            self._shared -= 1
+            if not self._shared:
+                self._condition.notify_all()
+
+    def acquire_exclusive(self, blocking=True):
+        with self._condition:
+            while self._exclusive or self._shared:
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self._exclusive = True
+            return True
+
+    def release_exclusive(self):
+        with self._condition:
+            self._exclusive = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire_exclusive()
+        try:
+            yield
+        finally:
+            self.release_exclusive()
+
+
+class ProductGraph:
+    """
+    Versions and memoized calls of the derived products of a Scene.
+
+    Each product remembers the key of its last calculation: a fingerprint of the
+    arguments and the versions of the products it depends on. Calling it again with the
+    same key returns the stored result without recalculating. Recalculating a product
+    bumps its version and those of all products downstream of it, so they are
+    recalculated on their next call while everything upstream stays cached.
+
+    Calculations hold the computing lock shared, so they may run concurrently with each
+    other, and snapshots of the products are taken with it held exclusively, between
+    calculations.
+    """
+
+    def __init__(self):
+        self.versions = dict()
+        self._last = dict()
+        # Products may be calculated concurrently by a StageScheduler
+        self._lock = threading.RLock()
+        self.computing = SharedLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock'], state['computing']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self.computing = SharedLock()
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def key(self, name, args, kwargs):
+        with self._lock:
+            versions = tuple(self.version(dep) for dep in DEPENDENCIES[name])
+        key = fingerprint(args), fingerprint(kwargs), versions
+        if name in FILE_ARGUMENTS:
+            # A file changed in place under the same path is read again
+            signature, files = FILE_ARGUMENTS[name]
+            arguments = signature.bind_partial(None, *args, **kwargs).arguments
+            key += tuple(file_stamp(arguments[file]) for file in files if arguments.get(file))
+        return key
+
+    def entries(self):
+        """Memo entries by product: the key, result and arguments of each one's last calculation."""
+        with self._lock:
+            return dict(self._last)
+
+    def cached(self, name, key):
+        """True, with the stored result, if the last calculation of name had this key."""
+        with self._lock:
+            last = self._last.get(name)
+        if last is not None and last[0] == key:
+            return True, last[1]
+        return False, None
+
+    def store(self, name, key, result, arguments=None):
+        with self._lock:
+            self._last[name] = (key, result, arguments)
+            self.invalidate(name)
+
+    def invalidate(self, name):
+        """Marks name and everything downstream of it as changed."""
+        with self._lock:
+            for product in {name} | descendants(name):
+                self.versions[product] = self.version(product) + 1
+            for product in descendants(name):
+                self._last.pop(product, None)
+
+
+def product(name, deps=(), files=()):
+    """
+    Declares a Scene method as the calculation of the product name, depending on deps.
+
+    The method is memoized through the Scene's ProductGraph: it only runs when its
+    arguments or an upstream product have changed since its last call. files names the
+    arguments that are paths of files the method reads, which also count as changed when
+    the file's modification time or size has. Once it has run, the Scene publishes a new
+    snapshot of its products.
+    """
+    DEPENDENCIES[name] = tuple(deps)
+
+    def decorator(method):
+        if files:
+            FILE_ARGUMENTS[name] = (inspect.signature(method), tuple(files))
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = self.products.key(name, args, kwargs)
+            hit, result = self.products.cached(name, key)
+            if hit:
+                return result
+            with self.products.computing.shared():
+                result = method(self, *args, **kwargs)
+                self.products.store(name, key, result, arguments=(args, kwargs))
+            self.publish()
+            return result
+        wrapper.product = name
+        return wrapper
+    return decorator
+
+
+class StageScheduler:
+    """
+    Runs pipeline stages on a thread pool, each as soon as the stages it depends on are done.
+
+    Stages are added with the names of the stages they must follow; independent stages run
+    concurrently, so the total time approaches that of the longest chain of stages rather
+    than the sum of all of them. The numpy kernels release the GIL for most of their work.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._stages = dict()
+
+    def add(self, name, func, *args, after=(), **kwargs):
+        self._stages[name] = (func, args, kwargs, tuple(after))
+        return self
+
+    def run(self):
+        """Runs all stages and returns their results by name; the first failure is raised."""
+        pending = dict(self._stages)
+        running = dict()
+        results = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [name for name, stage in pending.items() if all(dep in results for dep in stage[3])]
+                for name in ready:
+                    func, args, kwargs, after = pending.pop(name)
+                    running[executor.submit(func, *args, **kwargs)] = name
+                if not running:
+                    raise ValueError('Stages with unknown or circular dependencies: {}'.format(sorted(pending)))
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
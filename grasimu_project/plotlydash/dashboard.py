@@ -1,5 +1,9 @@
 """Instantiate a Dash app."""
+import base64
 import json
+import threading
+import uuid
+from collections import defaultdict
 import pandas as pd
 import dash
 import dash_html_components as html
@@ -9,13 +13,20 @@ import plotly.graph_objects as go
 import dash_core_components as dcc
 from dash.dependencies import Input, Output, State
 from ..constructors import Scene
+from ..jobs import JobQueue
+from ..pipeline import StageScheduler
+from ..sessions import SceneRegistry
+from ..state import SceneState
+from ..store import ArtifactStore
+from ..survey import clip_to_bounds, read_stations
 from plotly.subplots import make_subplots
 import plotly.express as px
 
+from .figures import compact, grid_attrs, viewport
 from .ui_top import sidebar, content_style
 from .ui_target import target_layout
 from .ui_terrain import terrain_layout
-from .ui_survey import survey_layout
+from .ui_survey import GRID_TEXT, SPIRAL_TEXT, survey_layout
 from .ui_vis import vis_layout
 
 
@@ -29,7 +40,13 @@ def init_dashboard(server):
     )
 
     content = html.Div(id="page-content", style=content_style)
-    dash_app.layout = html.Div([dcc.Location(id="url"), sidebar, content])
+
+    def serve_layout():
+        # Each browser tab gets its own session id, which keys its Scene on the server
+        session_id = dcc.Store(id='session_id', data=uuid.uuid4().hex, storage_type='session')
+        return html.Div([dcc.Location(id="url"), session_id, sidebar, content])
+
+    dash_app.layout = serve_layout
 
     # this callback uses the current pathname to set the active state of the
     # corresponding nav link to true, allowing users to see what page they are on.
@@ -43,7 +60,100 @@ def init_dashboard(server):
             return True, False, False
         return [pathname == f"/dashapp/page-{i}" for i in range(1, 4)]
 
-    sc = Scene('scene1')
+    # Expensive stages are cached on disk, so they survive restarts of the server
+    store = ArtifactStore(server.config['ARTIFACT_DIR'], max_bytes=server.config['ARTIFACT_MAX_BYTES'])
+    # Scenes are saved to the state directory after each request, so that any of the server's
+    # worker processes can serve any session
+    scene_state = SceneState(server.config['STATE_DIR'], max_age=server.config['STATE_MAX_AGE'])
+    scenes = SceneRegistry(lambda session: Scene(session, store=store, state=scene_state), state=scene_state,
+                           max_bytes=server.config['SESSION_MAX_BYTES'],
+                           idle_timeout=server.config['SESSION_IDLE_TIMEOUT'])
+
+    @server.after_request
+    def save_scenes(response):
+        scenes.commit()
+        return response
+
+    # Long calculations run as jobs in worker processes, which the plots poll with their intervals
+    jobs = JobQueue(max_workers=server.config['JOB_WORKERS'], status=scene_state.shared('jobs'),
+                    scenes=scenes.current)
+
+    # Progress of each session's coarse-to-fine gravity calculations and jobs, keyed by the
+    # session and the plot they feed, shared by the server's processes like the scenes
+    progressive = scene_state.shared('progress')
+    progressive_locks = defaultdict(threading.Lock)
+
+    def progress(session, key):
+        return progressive.get((session, key), dict(run=0, level=0, shown=0, levels=1, job=None))
+
+    def set_progress(session, key, **changes):
+        progressive[(session, key)] = dict(progress(session, key), **changes)
+
+    def progress_bar(fraction, state='running', error=None):
+        """Value and label of a progress bar."""
+        if state == 'failed':
+            return 100, 'Failed: {}'.format(error)
+        if state == 'cancelled':
+            return 0, 'Cancelled'
+        if state == 'stale':
+            return 0, 'Out of date: its inputs changed while it ran'
+        return round(100 * fraction), '{:.0f}%'.format(100 * fraction)
+
+    def run_progressive(sc, session, key, method, **kwargs):
+        """
+        Runs the Scene method on coarse voxel models of the target, then on the full voxel model.
+
+        The coarsest level is calculated before returning so that it can be shown straight
+        away, and the finer levels are calculated one after the other as jobs. method is
+        passed the voxel model to use as voxel_model, or None for the stored one. A new run
+        cancels the jobs of the previous one.
+        """
+        lock = progressive_locks[session, key]
+        models = sc.coarse_voxel_models() + [None]
+        with lock:
+            state = progress(session, key)
+            run = state['run'] + 1
+            if state['job'] is not None:
+                jobs.cancel(state['job'])
+            set_progress(session, key, run=run, job=None)
+            getattr(sc, method)(voxel_model=models[0], **kwargs)
+            set_progress(session, key, level=0, shown=0, levels=len(models))
+
+        def refine():
+            for level, model in enumerate(models[1:], 1):
+                with lock:
+                    # a newer run has started, so these results would be stale
+                    if progress(session, key)['run'] != run:
+                        return
+                    job = jobs.submit(sc, method, voxel_model=model, **kwargs)
+                    set_progress(session, key, job=job)
+                status = jobs.wait(job)
+                with lock:
+                    if progress(session, key)['run'] != run or status['state'] != 'done':
+                        return
+                    set_progress(session, key, level=level, job=None)
+                jobs.forget(job)
+
+        if len(models) > 1:
+            threading.Thread(target=refine, daemon=True).start()
+
+    def progressive_update(session, key):
+        """
+        Whether a finer result is ready to be shown, whether polling can stop, and the value
+        and label of the progress bar.
+        """
+        state = progress(session, key)
+        level = state['level']
+        updated = level > state['shown']
+        set_progress(session, key, shown=level)
+        done = level == state['levels'] - 1
+
+        job = state['job']
+        status = jobs.status(job) if job is not None else dict(state='running', progress=0, error=None)
+        if status['state'] in ('failed', 'cancelled', 'stale'):
+            return updated, True, progress_bar(0, status['state'], status['error'])
+        fraction = 1 if done else (level + status['progress']) / (state['levels'] - 1)
+        return updated, done, progress_bar(fraction)
 
     @dash_app.callback([Output('target_mesh_plot', 'figure'),
                         Output('voxel_button', 'disabled'),
@@ -55,9 +165,11 @@ def init_dashboard(server):
                         State('length_comp_input', 'value'),
                         State('cen_x_input', 'value'),
                         State('cen_y_input', 'value'),
-                        State('cen_z_input', 'value')],
+                        State('cen_z_input', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def render_mesh(click, path, mode, radius, length, x0, y0, z0):
+    def render_mesh(click, path, mode, radius, length, x0, y0, z0, session):
+        sc = scenes.get(session)
         voxel_button_status = True
         voxel_button_text = "No mesh in memory."
 
@@ -95,13 +207,16 @@ def init_dashboard(server):
                         Output('gravity_button', 'disabled'),
                         Output('gravity_button_text', 'children')],
                        Input('voxel_button', 'n_clicks'),
-                       State('voxel_resolution_input', 'value'),
+                       [State('voxel_resolution_input', 'value'),
+                        State('voxel_fraction_checkbox', 'checked'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def voxelize_mesh(click, resolution):
+    def voxelize_mesh(click, resolution, fractional, session):
+        sc = scenes.get(session)
         gravity_button_status = True
         gravity_button_text = "No voxel model in memory."
 
-        sc.voxelize_mesh(resolution=resolution)
+        sc.voxelize_mesh(resolution=resolution, fractional=bool(fractional))
 
         vox_fig = go.Figure(data=go.Mesh3d(x=sc.target_geometry['voxel']['vertices'][:, 0],
                                            y=sc.target_geometry['voxel']['vertices'][:, 1],
@@ -177,11 +292,13 @@ def init_dashboard(server):
                         State('auto_extent_collapse', 'is_open'),
                         State('extent_dem_checkbox', 'checked'),
                         State('extent_dem_path', 'value'),
-                        State('extent_dem_resolution', 'value')],
+                        State('extent_dem_resolution', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
     def plot_extent(click, resolution, extent_multiplier, extent_x1, extent_y1, extent_x2, extent_y2,
-                    auto_is_open, use_dem, path, dem_res):
+                    auto_is_open, use_dem, path, dem_res, session):
         ctx = dash.callback_context
+        sc = scenes.get(session)
 
         if auto_is_open:
             if use_dem:
@@ -232,54 +349,72 @@ def init_dashboard(server):
                                  xaxis=dict(scaleanchor='y'))
         return extent_fig
 
-    @dash_app.callback(Output('target_grav_plot', 'figure'),
+    @dash_app.callback([Output('target_grav_plot', 'figure'),
+                        Output('gravity_interval', 'disabled'),
+                        Output('gravity_progress', 'value'),
+                        Output('gravity_progress', 'children')],
                        [Input('gravity_button', 'n_clicks'),
-                        Input('target_tabs', 'active_tab')],
-                       [State('density_input', 'value')],
+                        Input('target_tabs', 'active_tab'),
+                        Input('gravity_interval', 'n_intervals')],
+                       [State('density_input', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def plot_perfect_gravity(click, tab, density):
+    def plot_perfect_gravity(click, tab, n_intervals, density, session):
         ctx = dash.callback_context
+        sc = scenes.get(session)
+        trigger = ctx.triggered[0]['prop_id'].split('.')[0]
 
-        if click is None and ctx.triggered[0]['prop_id'].split('.')[0] == 'target_tabs':
-            return None
-        elif ctx.triggered[0]['prop_id'].split('.')[0] == 'gravity_button':
-            sc.calculate_target_gravity(density_contrast=density, with_terrain=False)
+        if click is None and trigger == 'target_tabs':
+            return None, True, 0, ''
+        elif trigger == 'gravity_button':
             sc.calculate_analytical_sphere(rho=density)
-        num_attrs = dict(x=sc.data['perfect_gravity']['target'][0],
-                         y=sc.data['perfect_gravity']['target'][1],
-                         z=sc.data['perfect_gravity']['target'][2],
-                         colorbar_title="milligals")
-        ana_attrs = dict(x=sc.data['perfect_gravity']['ana'][0],
-                         y=sc.data['perfect_gravity']['ana'][1],
-                         z=sc.data['perfect_gravity']['ana'][2],
-                         colorbar_title="milligals")
+            run_progressive(sc, session, 'gravity', 'calculate_target_gravity',
+                            density_contrast=density, with_terrain=False)
+            done = progress(session, 'gravity')['levels'] == 1
+            bar = progress_bar(1 if done else 0)
+        elif trigger == 'gravity_interval':
+            updated, done, bar = progressive_update(session, 'gravity')
+            if not updated:
+                return (dash.no_update, done) + bar
+        else:
+            done = dash.no_update
+            bar = dash.no_update, dash.no_update
+        grid = sc.scene_properties['grid']
         if tab == 'target_tab_2':
-            fig_data = go.Heatmap(ana_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['perfect_gravity']['ana'], grid, colorbar_title="milligals"))
         elif tab == 'target_tab_1':
-            fig_data = go.Heatmap(num_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['perfect_gravity']['target'], grid, colorbar_title="milligals"))
 
         perfect_fig = go.Figure(fig_data)
         perfect_fig.update_layout(yaxis=dict(scaleanchor='x'),
                                   xaxis=dict(scaleanchor='y'))
 
-        return perfect_fig
+        return (perfect_fig, done) + bar
 
     @dash_app.callback([Output('terrain_plot', 'figure'),
                         Output('dem_button', 'disabled'),
-                        Output('dem_button_text', 'children')],
+                        Output('dem_button_text', 'children'),
+                        Output('terrain_interval', 'disabled')],
                        [Input('terrain_button', 'n_clicks'),
                         Input('terrain_tabs', 'active_tab'),
-                        Input('cmap_holder', 'children')],
+                        Input('cmap_holder', 'children'),
+                        Input('terrain_interval', 'n_intervals'),
+                        Input('terrain_plot', 'relayoutData')],
                        [State('seed_input', 'value'),
                         State('corr_x_input', 'value'),
                         State('corr_y_input', 'value'),
                         State('max_input', 'value'),
                         State('min_input', 'value'),
                         State('terrain_upload_path', 'value'),
-                        State('terrain_dropdown', 'value')],
+                        State('terrain_dropdown', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def plot_terrain(click, tab, cmap_dump, seed, corr_x, corr_y, max_in, min_in, path, method):
+    def plot_terrain(click, tab, cmap_dump, n_intervals, relayout, seed, corr_x, corr_y, max_in, min_in, path,
+                     method, session):
         ctx = dash.callback_context
+        sc = scenes.get(session)
+        trigger = ctx.triggered[0]['prop_id'].split('.')[0]
+        state = progress(session, 'terrain')
         if method == 6:
             path_status = False
         else:
@@ -287,16 +422,35 @@ def init_dashboard(server):
 
         dem_button_status = False
         dem_button_text = "No terrain surface in memory."
-        if ctx.triggered[0]['prop_id'].split('.')[0] == 'terrain_button':
-            sc.generate_terrain(seed=seed,
-                                method=method,
-                                x_corr_len=corr_x,
-                                y_corr_len=corr_y,
-                                max_elevation=max_in, min_elevation=min_in,
-                                path=path)
-
-        if click is None and ctx.triggered[0]['prop_id'].split('.')[0] == 'terrain_tabs':
-            return None, None, None
+        interval_disabled = dash.no_update
+        x_range = y_range = None
+        if trigger == 'terrain_plot':
+            # Zooming the raster sends the visible window at full resolution; the 3D surface has no ranges
+            ranges = viewport(relayout)
+            if tab != 'terrain_tab_2' or ranges is None:
+                return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+            x_range, y_range = ranges
+        elif trigger == 'terrain_button':
+            if state['job'] is not None:
+                jobs.cancel(state['job'])
+            set_progress(session, 'terrain', job=jobs.submit(sc, 'generate_terrain',
+                                                             seed=seed,
+                                                             method=method,
+                                                             x_corr_len=corr_x,
+                                                             y_corr_len=corr_y,
+                                                             max_elevation=max_in, min_elevation=min_in,
+                                                             path=path))
+            return dash.no_update, True, "Generating terrain surface...", False
+        elif trigger == 'terrain_interval':
+            status = jobs.status(state['job'])
+            if status['state'] in ('queued', 'running'):
+                return dash.no_update, True, "Generating terrain surface...", False
+            elif status['state'] != 'done':
+                return dash.no_update, True, progress_bar(0, status['state'], status['error'])[1], True
+            interval_disabled = True
+
+        if click is None and trigger == 'terrain_tabs':
+            return None, None, None, True
         else:
             if cmap_dump:
                 cmap_load = json.loads(cmap_dump)
@@ -308,23 +462,17 @@ def init_dashboard(server):
 
             dem_button_status = False
             dem_button_text = "Click to generate DTM surface."
-            raster_attrs = dict(x=sc.data['elevation']['terrain'][0],
-                                y=sc.data['elevation']['terrain'][1],
-                                z=sc.data['elevation']['terrain'][2],
-                                colorbar_title="metres",
-                                colorscale='Viridis',
-                                zmin=zmin, zmax=zmax)
-            surface_attrs = dict(x=sc.scene_properties['datum'][0],
-                                 y=sc.scene_properties['datum'][1],
-                                 z=sc.data['elevation']['terrain'][3],
-                                 colorbar_title="metres",
-                                 colorscale='Viridis',
-                                 cmin=zmin, cmax=zmax)
-
+            grid = sc.scene_properties['grid']
             if tab == 'terrain_tab_2':
-                fig_data = go.Heatmap(raster_attrs)
+                fig_data = go.Heatmap(grid_attrs(sc.data['elevation']['terrain'], grid, x_range, y_range,
+                                                 colorbar_title="metres",
+                                                 colorscale='Viridis',
+                                                 zmin=zmin, zmax=zmax))
             elif tab == 'terrain_tab_1':
-                fig_data = go.Surface(surface_attrs)
+                fig_data = go.Surface(grid_attrs(sc.data['elevation']['terrain'], grid,
+                                                 colorbar_title="metres",
+                                                 colorscale='Viridis',
+                                                 cmin=zmin, cmax=zmax))
                 vox_data = [go.Mesh3d(x=sc.target_geometry['voxel']['vertices'][:, 0],
                                       y=sc.target_geometry['voxel']['vertices'][:, 1],
                                       z=sc.target_geometry['voxel']['vertices'][:, 2],
@@ -339,8 +487,10 @@ def init_dashboard(server):
                                          line=dict(color='rgb(70,70,70)', width=1))]
 
             terrain_fig = go.Figure(fig_data)
+            # The zoom is kept when a window is sent, and reset when the terrain changes
             terrain_fig.update_layout(yaxis=dict(scaleanchor='x'),
-                                      xaxis=dict(scaleanchor='y'))
+                                      xaxis=dict(scaleanchor='y'),
+                                      uirevision='{}-{}'.format(tab, sc.products.version('terrain')))
             if tab == 'terrain_tab_1':
                 terrain_fig.add_trace(vox_data[0])
                 terrain_fig.add_trace(vox_data[1])
@@ -348,20 +498,33 @@ def init_dashboard(server):
 
             print(sc.data['elevation']['terrain'][2])
 
-            return terrain_fig, dem_button_status, dem_button_text
+            if trigger == 'terrain_plot':
+                return terrain_fig, dash.no_update, dash.no_update, dash.no_update
+            return terrain_fig, dem_button_status, dem_button_text, interval_disabled
 
     @dash_app.callback([Output('dem_plot', 'figure'),
                         Output('cmap_holder', 'children'),
                         Output('tgrav_button', 'disabled'),
                         Output('tgrav_button_text', 'children')],
                        [Input('dem_button', 'n_clicks'),
-                        Input('dem_tabs', 'active_tab')],
-                       [State('dem_input', 'value')],
+                        Input('dem_tabs', 'active_tab'),
+                        Input('dem_plot', 'relayoutData')],
+                       [State('dem_input', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def plot_dem(click, tab, dem_err):
+    def plot_dem(click, tab, relayout, dem_err, session):
         ctx = dash.callback_context
+        sc = scenes.get(session)
         tgrav_button_status = True
         tgrav_button_text = "No DTM in memory."
+        zoomed = ctx.triggered[0]['prop_id'].split('.')[0] == 'dem_plot'
+        x_range = y_range = None
+        if zoomed:
+            # Zooming the raster sends the visible window at full resolution; the 3D surface has no ranges
+            ranges = viewport(relayout)
+            if tab != 'dem_tab_2' or ranges is None:
+                return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+            x_range, y_range = ranges
         if ctx.triggered[0]['prop_id'].split('.')[0] == 'dem_button':
             sc.generate_dem(err=dem_err)
 
@@ -370,21 +533,20 @@ def init_dashboard(server):
         else:
             tgrav_button_status = False
             tgrav_button_text = "Click to calculate gravitational acceleration for true terrain and DTM."
-            raster_attrs = dict(x=sc.data['elevation']['dem'][0],
-                                y=sc.data['elevation']['dem'][1],
-                                z=sc.data['elevation']['dem'][2],
-                                colorbar_title="metres",
-                                colorscale='Viridis')
-            surface_attrs = dict(x=sc.scene_properties['datum'][0],
-                                 y=sc.scene_properties['datum'][1],
-                                 z=sc.data['elevation']['dem'][3],
-                                 colorbar_title="metres",
-                                 colorscale='Viridis')
+            zmin = np.min(sc.data['elevation']['dem'][2])
+            zmax = np.max(sc.data['elevation']['dem'][2])
 
+            grid = sc.scene_properties['grid']
             if tab == 'dem_tab_2':
-                fig_data = go.Heatmap(raster_attrs)
+                # The colour scale is that of the whole DTM, so it does not change with the zoom
+                fig_data = go.Heatmap(grid_attrs(sc.data['elevation']['dem'], grid, x_range, y_range,
+                                                 colorbar_title="metres",
+                                                 colorscale='Viridis',
+                                                 zmin=zmin, zmax=zmax))
             elif tab == 'dem_tab_1':
-                fig_data = go.Surface(surface_attrs)
+                fig_data = go.Surface(grid_attrs(sc.data['elevation']['dem'], grid,
+                                                 colorbar_title="metres",
+                                                 colorscale='Viridis'))
                 vox_data = [go.Mesh3d(x=sc.target_geometry['voxel']['vertices'][:, 0],
                                       y=sc.target_geometry['voxel']['vertices'][:, 1],
                                       z=sc.target_geometry['voxel']['vertices'][:, 2],
@@ -400,123 +562,154 @@ def init_dashboard(server):
 
             dem_fig = go.Figure(fig_data)
             dem_fig.update_layout(yaxis=dict(scaleanchor='x'),
-                                  xaxis=dict(scaleanchor='y'))
+                                  xaxis=dict(scaleanchor='y'),
+                                  uirevision='{}-{}'.format(tab, sc.products.version('dem')))
             if tab == 'dem_tab_1':
                 dem_fig.add_trace(vox_data[0])
                 dem_fig.add_trace(vox_data[1])
                 dem_fig.update_scenes(aspectmode='data')
 
-            zmin = np.min(sc.data['elevation']['dem'][2])
-            zmax = np.max(sc.data['elevation']['dem'][2])
+            if zoomed:
+                return dem_fig, dash.no_update, dash.no_update, dash.no_update
 
             cmap_dump = json.dumps([zmin, zmax])
 
             return dem_fig, cmap_dump, tgrav_button_status, tgrav_button_text
 
-    @dash_app.callback(Output('tgrav_plot', 'figure'),
+    @dash_app.callback([Output('tgrav_plot', 'figure'),
+                        Output('tgrav_interval', 'disabled'),
+                        Output('tgrav_progress', 'value'),
+                        Output('tgrav_progress', 'children')],
                        [Input('tgrav_button', 'n_clicks'),
-                        Input('tgrav_tabs', 'active_tab')],
-                       State('t_density_input', 'value'),
+                        Input('tgrav_tabs', 'active_tab'),
+                        Input('tgrav_interval', 'n_intervals'),
+                        Input('tgrav_cancel_button', 'n_clicks')],
+                       [State('t_density_input', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def plot_terrain_gravity(click, tab, density):
+    def plot_terrain_gravity(click, tab, n_intervals, cancel, density, session):
         ctx = dash.callback_context
-        if ctx.triggered[0]['prop_id'].split('.')[0] == 'tgrav_button':
-            sc.calculate_terrain_gravity(rho=density)
-
-        if click is None and ctx.triggered[0]['prop_id'].split('.')[0] == 'tgrav_tabs':
-            return None, None, None
+        sc = scenes.get(session)
+        trigger = ctx.triggered[0]['prop_id'].split('.')[0]
+        state = progress(session, 'tgrav')
+        interval_disabled = dash.no_update
+        bar = dash.no_update, dash.no_update
+        if trigger == 'tgrav_button':
+            if state['job'] is not None:
+                jobs.cancel(state['job'])
+            set_progress(session, 'tgrav', job=jobs.submit(sc, 'calculate_terrain_gravity', rho=density))
+            return (dash.no_update, False) + progress_bar(0)
+        elif trigger == 'tgrav_cancel_button':
+            # The interval picks up the cancellation once the job has stopped
+            if state['job'] is not None:
+                jobs.cancel(state['job'])
+            return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+        elif trigger == 'tgrav_interval':
+            status = jobs.status(state['job'])
+            if status['state'] in ('queued', 'running'):
+                return (dash.no_update, False) + progress_bar(status['progress'])
+            elif status['state'] != 'done':
+                return (dash.no_update, True) + progress_bar(0, status['state'], status['error'])
+            interval_disabled = True
+            bar = progress_bar(1)
+
+        if click is None and trigger == 'tgrav_tabs':
+            return None, True, 0, ''
         else:
-            dem_attrs = dict(x=sc.data['perfect_gravity']['dem'][0],
-                             y=sc.data['perfect_gravity']['dem'][1],
-                             z=sc.data['perfect_gravity']['dem'][2],
-                             colorbar_title="milligals")
-            gt_attrs = dict(x=sc.data['perfect_gravity']['terrain'][0],
-                            y=sc.data['perfect_gravity']['terrain'][1],
-                            z=sc.data['perfect_gravity']['terrain'][2],
-                            colorbar_title="milligals")
+            grid = sc.scene_properties['grid']
         if tab == 'tgrav_tab_2':
-            fig_data = go.Heatmap(dem_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['perfect_gravity']['dem'], grid, colorbar_title="milligals"))
         elif tab == 'tgrav_tab_1':
-            fig_data = go.Heatmap(gt_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['perfect_gravity']['terrain'], grid, colorbar_title="milligals"))
 
         tgrav_fig = go.Figure(fig_data)
         tgrav_fig.update_layout(yaxis=dict(scaleanchor='x'),
                                 xaxis=dict(scaleanchor='y'))
 
-        return tgrav_fig
+        return (tgrav_fig, interval_disabled) + bar
 
-    @dash_app.callback([Output(f'{i}_collapse', 'is_open') for i in ['grid', 'spiral', 'points']],
-                       [Input(f'{i}_display_button', 'n_clicks') for i in ['grid', 'spiral', 'points']],
-                       [State(f'{i}_collapse', 'is_open') for i in ['grid', 'spiral', 'points']],
+    @dash_app.callback([Output(f'{i}_collapse', 'is_open') for i in ['grid', 'spiral', 'import', 'points']],
+                       [Input(f'{i}_display_button', 'n_clicks') for i in ['grid', 'spiral', 'import', 'points']],
+                       [State(f'{i}_collapse', 'is_open') for i in ['grid', 'spiral', 'import', 'points']],
                        prevent_initial_call=True)
-    def survey_collapse(n1, n2, n3, is_open1, is_open2, is_open3):
+    def survey_collapse(n1, n2, n3, n4, is_open1, is_open2, is_open3, is_open4):
         ctx = dash.callback_context
 
         if not ctx.triggered:
-            return False, False, False
+            return False, False, False, False
         else:
             button_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
         if button_id == "grid_display_button" and n1:
-            return not is_open1, False, False
+            return not is_open1, False, False, False
         elif button_id == "spiral_display_button" and n2:
-            return False, not is_open2, False
-        elif button_id == "points_display_button" and n3:
-            return False, False, not is_open3
-        return False, False, False
-
-    @dash_app.callback(Output('survey_plot', 'figure'),
+            return False, not is_open2, False, False
+        elif button_id == "import_display_button" and n3:
+            return False, False, not is_open3, False
+        elif button_id == "points_display_button" and n4:
+            return False, False, False, not is_open4
+        return False, False, False, False
+
+    @dash_app.callback([Output('survey_plot', 'figure'),
+                        Output('survey_interval', 'disabled'),
+                        Output('survey_progress', 'value'),
+                        Output('survey_progress', 'children')],
                        [Input('simulate_button', 'n_clicks'),
-                        Input('survey_tabs', 'active_tab')],
+                        Input('survey_tabs', 'active_tab'),
+                        Input('survey_interval', 'n_intervals')],
                        [State('grav_err_input', 'value'),
-                        State('gps_err_input', 'value')],
+                        State('gps_err_input', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def plot_survey(click, tab, grav_err, gps_err):
+    def plot_survey(click, tab, n_intervals, grav_err, gps_err, session):
         ctx = dash.callback_context
-        if ctx.triggered[0]['prop_id'].split('.')[0] == 'simulate_button':
-            sc.calculate_target_gravity(sc.target_parameters['density'],
-                                        with_terrain=True,
-                                        with_noise=True,
-                                        grav_err=grav_err, gps_err=gps_err)
-            sc.calculate_target_gravity(sc.target_parameters['density'],
-                                        with_terrain=False,
-                                        with_noise=True,
-                                        grav_err=grav_err, gps_err=gps_err)
-            sc.calculate_target_gravity(sc.target_parameters['density'],
-                                        with_terrain=True,
-                                        with_noise=False,
-                                        grav_err=grav_err, gps_err=gps_err)
-        if click is None and ctx.triggered[0]['prop_id'].split('.')[0] == 'survey_tabs':
-            return None, None, None
+        sc = scenes.get(session)
+        trigger = ctx.triggered[0]['prop_id'].split('.')[0]
+
+        if trigger == 'simulate_button':
+            run_progressive(sc, session, 'survey', 'simulate',
+                            density_contrast=sc.target_parameters['density'],
+                            terrain_density=sc.terrain['density'],
+                            grav_err=grav_err, gps_err=gps_err)
+            done = progress(session, 'survey')['levels'] == 1
+            bar = progress_bar(1 if done else 0)
+        elif trigger == 'survey_interval':
+            updated, done, bar = progressive_update(session, 'survey')
+            if not updated:
+                return (dash.no_update, done) + bar
         else:
-            full_attrs = dict(x=sc.data['noisy_gravity']['full'][0],
-                              y=sc.data['noisy_gravity']['full'][1],
-                              z=sc.data['noisy_gravity']['full'][2],
-                              colorbar_title="milligals")
-            nt_attrs = dict(x=sc.data['noisy_gravity']['target'][0],
-                            y=sc.data['noisy_gravity']['target'][1],
-                            z=sc.data['noisy_gravity']['target'][2],
-                            colorbar_title="milligals")
+            done = dash.no_update
+            bar = dash.no_update, dash.no_update
+
+        if click is None and trigger == 'survey_tabs':
+            return None, True, 0, ''
+        else:
+            grid = sc.scene_properties['grid']
         if tab == 'survey_tab_1':
-            fig_data = go.Heatmap(full_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['noisy_gravity']['full'], grid, colorbar_title="milligals"))
         elif tab == 'survey_tab_2':
-            fig_data = go.Heatmap(nt_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['noisy_gravity']['target'], grid, colorbar_title="milligals"))
 
         survey_fig = go.Figure(fig_data)
         survey_fig.update_layout(yaxis=dict(scaleanchor='x'),
                                  xaxis=dict(scaleanchor='y'))
 
-        return survey_fig
+        return (survey_fig, done) + bar
 
-    @dash_app.callback([Output('survey_pick_plot', 'figure'),
-                        Output('interp_button', 'disabled'),
-                        Output('interp_button_text', 'children')],
-                       Input('survey_table', 'data'),
-                       [State('count_data', 'children')])
-    def pick_survey(data, count):
-        ctx = dash.callback_context
-        interp_button_status = True
-        interp_button_text = 'Not enough survey points in memory (at least 3 required).'
+    # Index of the station markers in survey_pick_plot, after the voxel mesh and datum surface
+    marker_trace = 2
+
+    def survey_scene_loaded(sc):
+        return sc.target_geometry['voxel']['model'] is not None and len(sc.scene_properties['datum']) > 0
+
+    def station_markers(stations):
+        return dict(x=[stations[:, 0]], y=[stations[:, 1]], z=[stations[:, 2]])
+
+    @dash_app.callback(Output('survey_pick_plot', 'figure'),
+                       Input('session_id', 'data'))
+    def pick_survey(session):
+        """Renders the static traces of the station picking plot once; stations are added through extendData."""
+        sc = scenes.get(session)
         try:
             survey_pick_fig = go.Figure(data=go.Mesh3d(x=sc.target_geometry['voxel']['vertices'][:, 0],
                                                        y=sc.target_geometry['voxel']['vertices'][:, 1],
@@ -524,11 +717,9 @@ def init_dashboard(server):
                                                        i=sc.target_geometry['voxel']['indices'][:, 0],
                                                        j=sc.target_geometry['voxel']['indices'][:, 1],
                                                        k=sc.target_geometry['voxel']['indices'][:, 2]))
-            survey_pick_fig.add_trace(go.Surface(x=(sc.scene_properties['datum'][0]),
-                                                 y=sc.scene_properties['datum'][1],
-                                                 z=sc.scene_properties['datum'][2],
-                                                 showscale=False,
-                                                 opacity=0.2))
+            survey_pick_fig.add_trace(go.Surface(grid_attrs(sc.scene_properties['datum'], sc.scene_properties['grid'],
+                                                            showscale=False,
+                                                            opacity=0.2)))
             survey_pick_fig.update_scenes(aspectmode='data',
                                           dragmode='zoom')
             survey_pick_fig.update_layout(scene_camera=dict(eye=dict(x=0., y=0., z=2),
@@ -536,68 +727,71 @@ def init_dashboard(server):
 
         except TypeError:
             print("No target or terrain data loaded.")
-            return go.Figure(), interp_button_status, interp_button_text
-
-        if ctx.triggered[0]['prop_id'].split('.')[0] == 'survey_table':
-            count = int(count) - 1
-            x_vals = [float(data[c]['column_1']) for c in range(count + 1)]
-            y_vals = [float(data[c]['column_2']) for c in range(count + 1)]
-            z_vals = [float(data[c]['column_3']) for c in range(count + 1)]
-
-            survey_pick_fig.add_trace(go.Scatter3d(x=x_vals,
-                                                   y=y_vals,
-                                                   z=z_vals,
-                                                   mode='markers',
-                                                   marker_color='white',
-                                                   marker_size=2))
-
-            if count > 1:
-                interp_button_status = False
-                interp_button_text = "Click to interpolate between survey points."
-
-        return survey_pick_fig, interp_button_status, interp_button_text
-
-    @dash_app.callback(Output('interp_plot', 'figure'),
+            return go.Figure()
+
+        stations = sc.stations(session)
+        survey_pick_fig.add_trace(go.Scatter3d(x=stations[:, 0],
+                                               y=stations[:, 1],
+                                               z=stations[:, 2],
+                                               mode='markers',
+                                               marker_color='white',
+                                               marker_size=2))
+        return survey_pick_fig
+
+    @dash_app.callback([Output('interp_button', 'disabled'),
+                        Output('interp_button_text', 'children')],
+                       Input('count_data', 'children'),
+                       State('session_id', 'data'))
+    def interp_button_status(count, session):
+        sc = scenes.get(session)
+        if len(sc.stations(session)) > 2:
+            return False, "Click to interpolate between survey points."
+        return True, 'Not enough survey points in memory (at least 3 required).'
+
+    @dash_app.callback([Output('interp_plot', 'figure'),
+                        Output('cv_table', 'children')],
                        [Input('interp_button', 'n_clicks'),
                         Input('interp_tabs', 'active_tab')],
                        [State('grav_err_input', 'value'),
                         State('gps_err_input', 'value'),
-                        State('survey_table', 'data'),
-                        State('count_data', 'children'),
-                        State('sip_radio', 'value')],
+                        State('sip_radio', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def plot_interpolated_survey(click, tab, grav_err, gps_err, data, count, method):
+    def plot_interpolated_survey(click, tab, grav_err, gps_err, method, session):
         ctx = dash.callback_context
+        sc = scenes.get(session)
         if ctx.triggered[0]['prop_id'].split('.')[0] == 'interp_button':
-            count = int(count) - 1
-            x_vals = [float(data[c]['column_1']) for c in range(count + 1)]
-            y_vals = [float(data[c]['column_2']) for c in range(count + 1)]
-            z_vals = [float(data[c]['column_3']) for c in range(count + 1)]
-
-            sc.update_survey(x_vals, y_vals, z_vals, grav_err, gps_err)
-            sc.interpolate_survey_pts(method=method)
+            stations = sc.stations(session)
+            sc.update_survey(stations[:, 0], stations[:, 1], stations[:, 2], grav_err, gps_err)
+            # Interpolation and cross-validation only read the survey, so they run concurrently
+            StageScheduler().add('interpolation', sc.interpolate_survey_pts, method=method) \
+                            .add('cross_validation', sc.cross_validate, method=method).run()
 
         if click is None and ctx.triggered[0]['prop_id'].split('.')[0] == 'interp_tabs':
-            return None, None, None
+            return None, None
         else:
-            interp_attrs = dict(x=sc.data['interp_gravity']['raw'][0],
-                                y=sc.data['interp_gravity']['raw'][1],
-                                z=sc.data['interp_gravity']['raw'][2],
-                                colorbar_title="milligals")
-            perfect_attrs = dict(x=sc.data['interp_gravity']['target'][0],
-                                 y=sc.data['interp_gravity']['target'][1],
-                                 z=sc.data['interp_gravity']['target'][2],
-                                 colorbar_title="milligals")
+            grid = sc.scene_properties['grid']
         if tab == 'interp_tab_2':
-            fig_data = go.Heatmap(perfect_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['interp_gravity']['target'], grid, colorbar_title="milligals"))
         elif tab == 'interp_tab_1':
-            fig_data = go.Heatmap(interp_attrs)
+            fig_data = go.Heatmap(grid_attrs(sc.data['interp_gravity']['raw'], grid, colorbar_title="milligals"))
+        elif tab == 'interp_tab_3':
+            fig_data = go.Heatmap(grid_attrs(sc.data['cv_error'], grid, colorbar_title="milligals"))
 
         interp_fig = go.Figure(fig_data)
         interp_fig.update_layout(yaxis=dict(scaleanchor='x'),
                                  xaxis=dict(scaleanchor='y'))
+        if tab == 'interp_tab_3':
+            stations = sc.measurements['locations']['target']
+            interp_fig.add_trace(go.Scatter(x=stations[0], y=stations[1], mode='markers',
+                                            marker=dict(color='black', size=4), name='Stations'))
+
+        stats = sc.measurements['cross_validation']['stats']
+        cv_df = pd.DataFrame([(k, v if isinstance(v, int) else '{:.4f} mgal'.format(v)) for k, v in stats.items()],
+                             columns=['Statistic', 'Value'])
+        cv_table = dbc.Table.from_dataframe(cv_df, size='sm')
 
-        return interp_fig
+        return interp_fig, cv_table
 
     @dash_app.callback(Output('click_data', 'children'),
                        [Input('survey_pick_plot', 'clickData')],
@@ -614,24 +808,112 @@ def init_dashboard(server):
     #                    prevent_initial_call=True)
     # def grid_builder(click_data):
 
-    # comment
+    # The survey table shows the latest stations of the session's survey
+    table_rows = 500
+
+    def station_table(stations):
+        start = max(len(stations) - table_rows, 0)
+        rows = [dict(id=i, column_1=x, column_2=y, column_3=z)
+                for i, (x, y, z) in enumerate(stations[start:].tolist(), start)]
+        return rows, 'Showing the last {} of {} stations.'.format(len(rows), len(stations))
+
     @dash_app.callback([Output('survey_table', 'data'),
-                        Output('count_data', 'children')],
+                        Output('survey_table_text', 'children'),
+                        Output('count_data', 'children'),
+                        Output('survey_pick_plot', 'extendData'),
+                        Output('station_upload_text', 'children'),
+                        Output('grid_text', 'children'),
+                        Output('spiral_text', 'children')],
                        [Input('click_data', 'children'),
-                        Input('new_survey_button', 'n_clicks')],
-                       [State('survey_table', 'data'),
-                        State('survey_table', 'columns')],
+                        Input('new_survey_button', 'n_clicks'),
+                        Input('add_grid_button', 'n_clicks'),
+                        Input('add_spiral_button', 'n_clicks'),
+                        Input('survey_table', 'data_timestamp'),
+                        Input('station_upload', 'contents')],
+                       [State('station_upload', 'filename'),
+                        State('survey_table', 'data'),
+                        State('grid_x_input', 'value'),
+                        State('grid_y_input', 'value'),
+                        State('grid_layout_radio', 'value'),
+                        State('grid_plot', 'selectedData'),
+                        State('turns_input', 'value'),
+                        State('points_input', 'value'),
+                        State('snap_checkbox', 'checked'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def update_table(pos, click, table_data, table_cols):
+    def update_table(pos, click, grid_click, spiral_click, edited, upload, filename, table_data, dx, dy, layout,
+                     selection, turns, points, snap, session):
         ctx = dash.callback_context
-        if ctx.triggered[0]['prop_id'].split('.')[0] == 'click_data':
+        trigger = ctx.triggered[0]['prop_id'].split('.')[0]
+        sc = scenes.get(session)
+        bounds = sc.scene_properties['scene_bounds']
+        added = None
+        upload_text = grid_text = spiral_text = dash.no_update
+
+        if trigger == 'click_data':
             data = json.loads(pos)
-            table_data.append({c['id']: data[i] for c, i in zip(table_cols, range(0, 3))})
-            count = len(table_data)
-        elif ctx.triggered[0]['prop_id'].split('.')[0] == 'new_survey_button':
-            table_data = list()
-            count = 0
-        return table_data, count
+            added = sc.add_stations(data[0], data[1], data[2], snap=bool(snap), session=session)
+        elif trigger == 'new_survey_button':
+            sc.clear_stations(session=session)
+        elif trigger == 'add_grid_button':
+            if selection and 'range' in selection:
+                x_range, y_range = sorted(selection['range']['x']), sorted(selection['range']['y'])
+                bounds = [x_range[0], y_range[0], x_range[1], y_range[1]]
+            # Inputs outside their min are sent as None
+            if dx is None or dy is None or dx <= 0 or dy <= 0:
+                grid_text = 'The grid spacing in x and y must be positive.'
+            else:
+                added = sc.generate_stations(layout, snap=bool(snap), session=session,
+                                             bounds=bounds, dx=float(dx), dy=float(dy))
+                grid_text = GRID_TEXT
+        elif trigger == 'add_spiral_button':
+            centre = sc.target_geometry['mesh']['centre'][:2]
+            # The spiral fits in the scene around the target, if its centre is inside it
+            radius = max(min(centre[0] - bounds[0], bounds[2] - centre[0],
+                             centre[1] - bounds[1], bounds[3] - centre[1]), 0) if len(centre) == 2 else 0
+            if turns is None or points is None or turns <= 0 or points < 1:
+                spiral_text = 'The number of turns and of points must be positive.'
+            elif radius == 0:
+                spiral_text = 'The spiral is centred on the target, which must be inside the scene.'
+            else:
+                added = sc.generate_stations('spiral', snap=bool(snap), session=session,
+                                             centre=centre, radius=radius, turns=float(turns), points=int(points))
+                spiral_text = SPIRAL_TEXT
+        elif trigger == 'station_upload':
+            content_type, content_string = upload.split(',', 1)
+            terrain = sc.data['elevation']['terrain']
+            # Station elevations are converted to heights above the true terrain
+            ground = (lambda x, y: sc.scene_properties['grid'].sample(terrain[3], x, y)) if len(terrain) else None
+            try:
+                imported = read_stations(base64.b64decode(content_string).decode('utf-8'), ground=ground)
+            except (KeyError, ValueError, UnicodeDecodeError, pd.errors.ParserError) as err:
+                imported = None
+                upload_text = 'Could not read {}: {}'.format(filename, err)
+            if imported is not None:
+                inside = clip_to_bounds(imported['x'], imported['y'], bounds)
+                added = sc.add_stations(imported['x'], imported['y'], imported['z'], snap=bool(snap), session=session)
+                upload_text = ('Imported {} of {} stations from {}: {} outside the scene, {} duplicates.'
+                               .format(len(added), len(imported), filename, int((~inside).sum()),
+                                       int(inside.sum()) - len(added)))
+        elif trigger == 'survey_table':
+            # Cell edits are written back to the stations they show
+            sc.edit_stations({row['id']: [float(row['column_1']), float(row['column_2']), float(row['column_3'])]
+                              for row in table_data}, session=session)
+
+        stations = sc.stations(session)
+        # Only the station markers are sent to the plot: new stations are appended, and
+        # otherwise the markers are replaced by keeping just the last len(stations) points
+        if not survey_scene_loaded(sc) or (added is not None and not len(added)):
+            extend = dash.no_update
+        elif added is not None:
+            extend = [station_markers(added), [marker_trace]]
+        elif len(stations):
+            extend = [station_markers(stations), [marker_trace], len(stations)]
+        else:
+            extend = [station_markers(np.full((1, 3), np.nan)), [marker_trace], 1]
+
+        table_data, table_text = station_table(stations)
+        return table_data, table_text, len(stations), extend, upload_text, grid_text, spiral_text
 
     # Target Geometry active/inactive fields callback
     @dash_app.callback([Output('radius_comp_input', 'disabled'),
@@ -697,9 +979,11 @@ def init_dashboard(server):
                         Input('vis_slice_dropdown', 'value'),
                         Input('correction_radio', 'value'),
                         Input('vis_tabs', 'active_tab')],
+                       State('session_id', 'data'),
                        prevent_initial_call=True)
-    def vis(click, pos, value, correction, tab):
+    def vis(click, pos, value, correction, tab, session):
         ctx = dash.callback_context
+        sc = scenes.get(session)
         if correction == [0, 1] or correction == [1, 0]:
             sc.apply_corrections(free_air=True, terrain=True)
         elif correction == [0]:
@@ -708,21 +992,26 @@ def init_dashboard(server):
             sc.apply_corrections(free_air=False, terrain=True)
         else:
             sc.apply_corrections(free_air=False, terrain=False)
-
-        selected_plot_list = [sc.data['interp_gravity']['target'],
-                              sc.data['interp_gravity']['full'],
-                              sc.data['interp_gravity']['raw'],
-                              sc.data['perfect_gravity']['target'],
-                              sc.data['perfect_gravity']['full'],
-                              sc.data['noisy_gravity']['full'],
-                              sc.data['perfect_gravity']['terrain'],
-                              sc.data['perfect_gravity']['dem'],
-                              sc.corrections['free_air'],
-                              sc.corrections['terrain'],
-                              sc.data['elevation']['terrain'],
-                              sc.data['elevation']['dem'],
-                              sc.data['corrected_gravity']['full'],
-                              sc.data['corrected_gravity']['interp']]
+        # Render a consistent set of products, even while others are being recalculated. The
+        # corrections may not have been published if another calculation was running, so the
+        # snapshot waits for it
+        sc.publish(blocking=True)
+        snap = sc.snapshot()
+
+        selected_plot_list = [snap.data['interp_gravity']['target'],
+                              snap.data['interp_gravity']['full'],
+                              snap.data['interp_gravity']['raw'],
+                              snap.data['perfect_gravity']['target'],
+                              snap.data['perfect_gravity']['full'],
+                              snap.data['noisy_gravity']['full'],
+                              snap.data['perfect_gravity']['terrain'],
+                              snap.data['perfect_gravity']['dem'],
+                              snap.corrections['free_air'],
+                              snap.corrections['terrain'],
+                              snap.data['elevation']['terrain'],
+                              snap.data['elevation']['dem'],
+                              snap.data['corrected_gravity']['full'],
+                              snap.data['corrected_gravity']['interp']]
 
         if value == 10 or value == 11:
             unit = 'metres'
@@ -741,27 +1030,27 @@ def init_dashboard(server):
                         selected_plot_list[4][3],
                         selected_plot_list[12][3]]
 
-        c1_fig = px.imshow(img=np.flipud(data[0]),
-                           x=sc.scene_properties['datum'][0][0, :],
-                           y=sc.scene_properties['datum'][1][:, 0])
+        c1_fig = px.imshow(img=compact(np.flipud(data[0])),
+                           x=snap.scene_properties['datum'][0][0, :],
+                           y=snap.scene_properties['datum'][1][:, 0])
 
         c1_fig.update_layout(coloraxis_colorbar=dict(title='milligal'))
 
-        c2_fig = px.imshow(img=np.flipud(data[1]),
-                           x=sc.scene_properties['datum'][0][0, :],
-                           y=sc.scene_properties['datum'][1][:, 0])
+        c2_fig = px.imshow(img=compact(np.flipud(data[1])),
+                           x=snap.scene_properties['datum'][0][0, :],
+                           y=snap.scene_properties['datum'][1][:, 0])
 
         c2_fig.update_layout(coloraxis_colorbar=dict(title='milligal'))
 
-        c3_fig = px.imshow(img=np.flipud(data[2]),
-                           x=sc.scene_properties['datum'][0][0, :],
-                           y=sc.scene_properties['datum'][1][:, 0])
+        c3_fig = px.imshow(img=compact(np.flipud(data[2])),
+                           x=snap.scene_properties['datum'][0][0, :],
+                           y=snap.scene_properties['datum'][1][:, 0])
 
         c3_fig.update_layout(coloraxis_colorbar=dict(title='milligal'))
 
-        slice_fig = px.imshow(img=np.flipud(selected_plot_list[value][3]),
-                              x=sc.scene_properties['datum'][0][0, :],
-                              y=sc.scene_properties['datum'][1][:, 0])
+        slice_fig = px.imshow(img=compact(np.flipud(selected_plot_list[value][3])),
+                              x=snap.scene_properties['datum'][0][0, :],
+                              y=snap.scene_properties['datum'][1][:, 0])
         slice_fig.update_xaxes(spikemode='across', showspikes=True)
         slice_fig.update_yaxes(spikemode='across', showspikes=True)
 
@@ -770,12 +1059,12 @@ def init_dashboard(server):
             x_pos = click_data[0]
             y_pos = click_data[1]
 
-            x_trace = go.Scatter(x=sc.scene_properties['datum'][0][0, :],
-                                 y=np.ones_like(sc.scene_properties['datum'][0][0, :]) * y_pos,
+            x_trace = go.Scatter(x=snap.scene_properties['datum'][0][0, :],
+                                 y=np.ones_like(snap.scene_properties['datum'][0][0, :]) * y_pos,
                                  marker_color='cyan',
                                  name="E-W")
-            y_trace = go.Scatter(x=np.ones_like(sc.scene_properties['datum'][1][0, :]) * x_pos,
-                                 y=sc.scene_properties['datum'][1][:, 0],
+            y_trace = go.Scatter(x=np.ones_like(snap.scene_properties['datum'][1][0, :]) * x_pos,
+                                 y=snap.scene_properties['datum'][1][:, 0],
                                  marker_color='lightgreen',
                                  name="N-S")
 
@@ -788,40 +1077,40 @@ def init_dashboard(server):
     @dash_app.callback([Output('vis_table', 'children'),
                         Output('vis_3d_plot', 'figure')],
                        [Input('vis_target_plot', 'figure'),
-                        Input('sum_tabs', 'active_tab')])
-    def vis_summary(click, tab):
-        sim_df = pd.DataFrame(list(zip(sc.sim_params.keys(), sc.sim_params.values())),
+                        Input('sum_tabs', 'active_tab')],
+                       State('session_id', 'data'))
+    def vis_summary(click, tab, session):
+        snap = scenes.get(session).snapshot()
+        sim_df = pd.DataFrame(list(zip(snap.sim_params.keys(), snap.sim_params.values())),
                               columns=['Parameter', 'Value'])
 
         param_table = dbc.Table.from_dataframe(sim_df)
 
-        terrain_data = go.Surface(x=sc.scene_properties['datum'][0],
-                                  y=sc.scene_properties['datum'][1],
-                                  z=sc.data['elevation']['terrain'][3],
-                                  colorbar_title="metres",
-                                  colorscale='Viridis')
+        terrain_data = go.Surface(grid_attrs(snap.data['elevation']['terrain'], snap.scene_properties['grid'],
+                                             colorbar_title="metres",
+                                             colorscale='Viridis'))
 
         if tab == 'sum_tab_1':
             fig = go.Figure(terrain_data)
-            fig.add_trace(go.Mesh3d(x=sc.target_geometry['mesh']['vertices'][:, 0],
-                                    y=sc.target_geometry['mesh']['vertices'][:, 1],
-                                    z=sc.target_geometry['mesh']['vertices'][:, 2],
-                                    i=sc.target_geometry['mesh']['indices'][:, 0],
-                                    j=sc.target_geometry['mesh']['indices'][:, 1],
-                                    k=sc.target_geometry['mesh']['indices'][:, 2],
+            fig.add_trace(go.Mesh3d(x=snap.target_geometry['mesh']['vertices'][:, 0],
+                                    y=snap.target_geometry['mesh']['vertices'][:, 1],
+                                    z=snap.target_geometry['mesh']['vertices'][:, 2],
+                                    i=snap.target_geometry['mesh']['indices'][:, 0],
+                                    j=snap.target_geometry['mesh']['indices'][:, 1],
+                                    k=snap.target_geometry['mesh']['indices'][:, 2],
                                     color='rgb(77,81,255)'))
         elif tab == 'sum_tab_2':
             fig = go.Figure(terrain_data)
-            fig.add_trace(go.Mesh3d(x=sc.target_geometry['voxel']['vertices'][:, 0],
-                                    y=sc.target_geometry['voxel']['vertices'][:, 1],
-                                    z=sc.target_geometry['voxel']['vertices'][:, 2],
-                                    i=sc.target_geometry['voxel']['indices'][:, 0],
-                                    j=sc.target_geometry['voxel']['indices'][:, 1],
-                                    k=sc.target_geometry['voxel']['indices'][:, 2],
+            fig.add_trace(go.Mesh3d(x=snap.target_geometry['voxel']['vertices'][:, 0],
+                                    y=snap.target_geometry['voxel']['vertices'][:, 1],
+                                    z=snap.target_geometry['voxel']['vertices'][:, 2],
+                                    i=snap.target_geometry['voxel']['indices'][:, 0],
+                                    j=snap.target_geometry['voxel']['indices'][:, 1],
+                                    k=snap.target_geometry['voxel']['indices'][:, 2],
                                     color='rgb(77,81,255)'))
-            fig.add_trace(go.Scatter3d(x=sc.target_geometry['wireframe'][0],
-                                       y=sc.target_geometry['wireframe'][1],
-                                       z=sc.target_geometry['wireframe'][2],
+            fig.add_trace(go.Scatter3d(x=snap.target_geometry['wireframe'][0],
+                                       y=snap.target_geometry['wireframe'][1],
+                                       z=snap.target_geometry['wireframe'][2],
                                        mode='lines',
                                        line=dict(color='rgb(70,70,70)', width=1)))
         return param_table, fig
@@ -829,23 +1118,25 @@ def init_dashboard(server):
     @dash_app.callback(Output('vis_xy_plot', 'figure'),
                        [Input('vis_click_data', 'children'),
                         Input('vis_target_toggle', 'value')],
-                       State('vis_slice_dropdown', 'value'),
+                       [State('vis_slice_dropdown', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def vis_slice(pos, toggle, value):
-        selected_plot_list = [sc.data['interp_gravity']['target'],
-                              sc.data['interp_gravity']['full'],
-                              sc.data['interp_gravity']['raw'],
-                              sc.data['perfect_gravity']['target'],
-                              sc.data['perfect_gravity']['full'],
-                              sc.data['noisy_gravity']['full'],
-                              sc.data['perfect_gravity']['terrain'],
-                              sc.data['perfect_gravity']['dem'],
-                              sc.corrections['free_air'],
-                              sc.corrections['terrain'],
-                              sc.data['elevation']['terrain'],
-                              sc.data['elevation']['dem'],
-                              sc.data['corrected_gravity']['full'],
-                              sc.data['corrected_gravity']['interp']]
+    def vis_slice(pos, toggle, value, session):
+        snap = scenes.get(session).snapshot()
+        selected_plot_list = [snap.data['interp_gravity']['target'],
+                              snap.data['interp_gravity']['full'],
+                              snap.data['interp_gravity']['raw'],
+                              snap.data['perfect_gravity']['target'],
+                              snap.data['perfect_gravity']['full'],
+                              snap.data['noisy_gravity']['full'],
+                              snap.data['perfect_gravity']['terrain'],
+                              snap.data['perfect_gravity']['dem'],
+                              snap.corrections['free_air'],
+                              snap.corrections['terrain'],
+                              snap.data['elevation']['terrain'],
+                              snap.data['elevation']['dem'],
+                              snap.data['corrected_gravity']['full'],
+                              snap.data['corrected_gravity']['interp']]
 
         if value == 10 or value == 11:
             unit = 'metres'
@@ -856,8 +1147,7 @@ def init_dashboard(server):
         x_pos = click_data[0]
         y_pos = click_data[1]
 
-        idx = np.where(sc.scene_properties['datum'][0] == x_pos)[1][0]
-        idy = np.where(sc.scene_properties['datum'][1] == y_pos)[0][0]
+        idy, idx = snap.scene_properties['grid'].index(x_pos, y_pos)
 
         y_min = np.min(np.flipud(selected_plot_list[value][3]))
         y_max = np.max(np.flipud(selected_plot_list[value][3]))
@@ -868,21 +1158,21 @@ def init_dashboard(server):
                             y_title='Signal Strength, ' + unit)
 
         fig.append_trace(go.Scatter(y=np.flipud(selected_plot_list[value][3])[idy, :],
-                                    x=sc.scene_properties['datum'][0][idx, :],
+                                    x=snap.scene_properties['datum'][0][idx, :],
                                     name='E-W', marker_color='cyan'),
                          row=1, col=1)
         fig.append_trace(go.Scatter(y=np.flipud(selected_plot_list[value][3])[:, idx],
-                                    x=sc.scene_properties['datum'][1][:, idx],
+                                    x=snap.scene_properties['datum'][1][:, idx],
                                     name='N-S', marker_color='lightgreen'),
                          row=2, col=1)
 
         if toggle == [0] and (value not in range(8, 11)):
             fig.append_trace(go.Scatter(y=np.flipud(selected_plot_list[3][3])[idy, :],
-                                        x=sc.scene_properties['datum'][0][idx, :],
+                                        x=snap.scene_properties['datum'][0][idx, :],
                                         name='Target', marker_color='red'),
                              row=1, col=1)
             fig.append_trace(go.Scatter(y=np.flipud(selected_plot_list[3][3])[:, idx],
-                                        x=sc.scene_properties['datum'][1][:, idx],
+                                        x=snap.scene_properties['datum'][1][:, idx],
                                         name='Target', marker_color='red', showlegend=False),
                              row=2, col=1)
 
@@ -921,23 +1211,25 @@ def init_dashboard(server):
     @dash_app.callback(Output('vis_dl_button', 'children'),
                        Input('vis_save_button', 'n_clicks'),
                        [State('vis_dl_checkbox', 'value'),
-                        State('vis_path_input', 'value')],
+                        State('vis_path_input', 'value'),
+                        State('session_id', 'data')],
                        prevent_initial_call=True)
-    def download_data(click, value, path):
-        data_list = [sc.data['interp_gravity']['target'],
-                     sc.data['interp_gravity']['full'],
-                     sc.data['interp_gravity']['raw'],
-                     sc.data['perfect_gravity']['target'],
-                     sc.data['perfect_gravity']['full'],
-                     sc.data['noisy_gravity']['full'],
-                     sc.data['perfect_gravity']['terrain'],
-                     sc.data['perfect_gravity']['dem'],
-                     sc.corrections['free_air'],
-                     sc.corrections['terrain'],
-                     sc.data['elevation']['terrain'],
-                     sc.data['elevation']['dem'],
-                     sc.data['corrected_gravity']['full'],
-                     sc.data['corrected_gravity']['interp']]
+    def download_data(click, value, path, session):
+        snap = scenes.get(session).snapshot()
+        data_list = [snap.data['interp_gravity']['target'],
+                     snap.data['interp_gravity']['full'],
+                     snap.data['interp_gravity']['raw'],
+                     snap.data['perfect_gravity']['target'],
+                     snap.data['perfect_gravity']['full'],
+                     snap.data['noisy_gravity']['full'],
+                     snap.data['perfect_gravity']['terrain'],
+                     snap.data['perfect_gravity']['dem'],
+                     snap.corrections['free_air'],
+                     snap.corrections['terrain'],
+                     snap.data['elevation']['terrain'],
+                     snap.data['elevation']['dem'],
+                     snap.data['corrected_gravity']['full'],
+                     snap.data['corrected_gravity']['interp']]
         label_list = ['Interp_Only_Target_Signal',
                       'Interp_Target_Terrain_no_noise',
                       'Interp_Target_Terrain_with_noise',
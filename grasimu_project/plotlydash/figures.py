@@ -0,0 +1,76 @@
+import numpy as np
+import plotly
+
+# plotly.py 6 sends numpy arrays to the browser as base64 typed arrays, older versions as JSON lists
+TYPED_ARRAYS = int(plotly.__version__.split('.')[0]) >= 6
+
+# Grid points along each axis of a gridded trace, about the pixel size of a dashboard plot
+VIEWPORT_POINTS = 512
+
+
+def compact(values, digits=7):
+    """
+    values as a float array for a figure, at float32 precision.
+
+    With typed arrays this is a float32 array, sent as 4 bytes a value. Otherwise the values
+    are rounded to digits significant figures, about what float32 holds, so that each is
+    written to JSON as a short number rather than the 17 digits of a float64.
+    """
+    values = np.asarray(values, dtype=float)
+    if TYPED_ARRAYS:
+        return values.astype(np.float32)
+    finite = np.abs(values[np.isfinite(values)])
+    scale = finite.max() if finite.size else 0
+    if scale == 0:
+        return values
+    return np.round(values, digits - 1 - int(np.floor(np.log10(scale))))
+
+
+def viewport(relayout):
+    """
+    x and y ranges of a 2D plot after its relayoutData event, None for an axis showing its full range.
+
+    Returns None if the event leaves the axes as they were, e.g. on resizing or on moving the
+    camera of a 3D plot, which has no axis ranges to follow.
+    """
+    if not relayout or not any(key.startswith(('xaxis.', 'yaxis.')) for key in relayout):
+        return None
+    ranges = []
+    for axis in ['xaxis', 'yaxis']:
+        if axis + '.range[0]' in relayout:
+            ranges.append((relayout[axis + '.range[0]'], relayout[axis + '.range[1]']))
+        else:
+            ranges.append(relayout.get(axis + '.range'))
+    return ranges
+
+
+def window(grid, x_range=None, y_range=None, points=VIEWPORT_POINTS):
+    """
+    Row and column slices of the points of grid in x_range and y_range, by default all of them,
+    strided to about points along each axis.
+    """
+    row, col = grid.fractional_index(grid.x[[0, -1]] if x_range is None else x_range,
+                                     grid.y[[0, -1]] if y_range is None else y_range)
+
+    def axis(bounds, n):
+        low, high = sorted(bounds)
+        # The points just outside the range are included, so the trace reaches the plot's edges
+        start = min(max(int(np.floor(low)), 0), n)
+        stop = min(max(int(np.ceil(high)) + 1, start), n)
+        return slice(start, stop, max(-(-(stop - start) // points), 1))
+
+    return axis(row, grid.shape[0]), axis(col, grid.shape[1])
+
+
+def grid_attrs(product, grid, x_range=None, y_range=None, points=VIEWPORT_POINTS, **attrs):
+    """
+    x, y and z of a Heatmap or Surface of a gridded product [x, y, values, grid values], and attrs.
+
+    The product is sent as the 1D axes of its RegularGrid and a 2D z, rather than as x, y
+    and z triples for every grid point. Only the window of the grid in x_range and y_range
+    is sent, with about points along each axis, so a plot's payload is set by its size on
+    screen rather than by the resolution of the grid.
+    """
+    rows, cols = window(grid, x_range, y_range, points)
+    z = np.reshape(product[2], grid.shape)[rows, cols]
+    return dict(x=compact(grid.x[cols]), y=compact(grid.y[rows]), z=compact(z), **attrs)
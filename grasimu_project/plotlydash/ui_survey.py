@@ -3,6 +3,10 @@ import dash_bootstrap_components as dbc
 import dash_html_components as html
 import dash_table
 
+# Help text of the station layouts, replaced by the reason when their inputs are invalid
+GRID_TEXT = "Add a grid of points to the survey design."
+SPIRAL_TEXT = "Add a spiral of points to the survey design."
+
 # Page 3 Content, where the user specifies the survey configuration
 survey_header = html.Div([html.H1(children='Survey Configuration'),
                           html.Hr()])
@@ -38,7 +42,7 @@ survey_opts_card = dbc.Card([
                                 dbc.FormGroup([
                                     dbc.InputGroup([
                                         dbc.InputGroupAddon("x", addon_type="prepend"),
-                                        dbc.Input(id='grid_x_input', type='number', value=10,
+                                        dbc.Input(id='grid_x_input', type='number', value=10, min=1,
                                                   disabled=False),
                                         dbc.InputGroupAddon("metres", addon_type="append"),
 
@@ -51,7 +55,7 @@ survey_opts_card = dbc.Card([
                                 dbc.FormGroup([
                                     dbc.InputGroup([
                                         dbc.InputGroupAddon("y", addon_type="prepend"),
-                                        dbc.Input(id='grid_y_input', type='number', value=10,
+                                        dbc.Input(id='grid_y_input', type='number', value=10, min=1,
                                                   disabled=False),
                                         dbc.InputGroupAddon("metres", addon_type="append"),
 
@@ -62,6 +66,17 @@ survey_opts_card = dbc.Card([
                             ]),
 
                         ], form=True),
+                        dbc.FormGroup([
+                            dbc.Label('Grid Layout'),
+                            dbc.RadioItems(id='grid_layout_radio',
+                                           options=[
+                                               {'label': "Regular", 'value': 'grid'},
+                                               {'label': "Staggered", 'value': 'staggered'},
+                                           ],
+                                           value='grid',
+                                           inline=True,
+                                           persistence=True),
+                        ]),
                         dbc.FormGroup([
                             dcc.Graph(id='grid_plot'),
                             dbc.FormText("Click and drag to select grid extent in x and y. Possible points are "
@@ -75,7 +90,7 @@ survey_opts_card = dbc.Card([
                                        outline=True,
                                        block=True,
                                        disabled=False),
-                            dbc.FormText("Add a grid of points to the survey design.")
+                            dbc.FormText(GRID_TEXT, id='grid_text')
                         ]),
 
                     ]),
@@ -96,8 +111,8 @@ survey_opts_card = dbc.Card([
                                 dbc.FormGroup([
                                     dbc.Label('Number of Turns'),
                                     dbc.InputGroup([
-                                        dbc.Input(id='turns_input', type='number', persistence=True,
-                                                  disabled=False),
+                                        dbc.Input(id='turns_input', type='number', value=3, min=0.5, step=0.5,
+                                                  persistence=True, disabled=False),
                                     ]),
 
                                 ]),
@@ -107,8 +122,8 @@ survey_opts_card = dbc.Card([
                                 dbc.FormGroup([
                                     dbc.Label('Number of Points'),
                                     dbc.InputGroup([
-                                        dbc.Input(id='points_input', type='number', persistence=True,
-                                                  disabled=False),
+                                        dbc.Input(id='points_input', type='number', value=50, min=1, step=1,
+                                                  persistence=True, disabled=False),
 
                                     ]),
 
@@ -125,7 +140,7 @@ survey_opts_card = dbc.Card([
                                        outline=True,
                                        block=True,
                                        disabled=False),
-                            dbc.FormText("Add a spiral of points to the survey design.")
+                            dbc.FormText(SPIRAL_TEXT, id='spiral_text')
                         ]),
 
                     ]),
@@ -133,6 +148,28 @@ survey_opts_card = dbc.Card([
                     is_open=False
                 )
             ]),
+            dbc.Card([
+                dbc.CardHeader(
+                    dbc.Button('Import Station File',
+                               id='import_display_button',
+                               color='link'),
+                ),
+                dbc.Collapse(
+                    dbc.CardBody([
+                        dbc.FormGroup([
+                            dcc.Upload(id='station_upload',
+                                       children=html.Div(['Drag and drop or ', html.A('select a station file')]),
+                                       style={'borderWidth': '1px', 'borderStyle': 'dashed', 'borderRadius': '5px',
+                                              'textAlign': 'center', 'padding': '10px'}),
+                            dbc.FormText("CSV or whitespace-separated columns x, y and optionally z (height above "
+                                         "the ground) and time, in that order or named in a header row.",
+                                         id='station_upload_text')
+                        ]),
+                    ]),
+                    id='import_collapse',
+                    is_open=False
+                )
+            ]),
             dbc.Card([
                 dbc.CardHeader(
                     dbc.Button('View Point Locations',
@@ -142,6 +179,7 @@ survey_opts_card = dbc.Card([
                 dbc.Collapse(
                     dbc.CardBody([
                         dbc.Label('Click in a cell to change the coordinate.'),
+                        dbc.FormText(id='survey_table_text'),
                         dash_table.DataTable(id='survey_table',
                                              columns=[{
                                                  'name': a,
@@ -160,6 +198,11 @@ survey_opts_card = dbc.Card([
         ]),
     ]),
     dbc.CardFooter([
+        dbc.FormGroup([
+            dbc.Checkbox(id='snap_checkbox', className='form-check-input', persistence=True),
+            dbc.Label('Snap to calculation grid', html_for='snap_checkbox', className='form-check-label'),
+            dbc.FormText("Move added stations to the nearest point of the calculation grid.")
+        ], check=True),
         dbc.FormGroup([
             dbc.Button('Delete Survey',
                        id='new_survey_button',
@@ -184,7 +227,9 @@ instrument_plot_card = dbc.Card(
         dbc.CardBody(
             [
                 dbc.Col([
-                    dcc.Graph(id='survey_plot')
+                    dcc.Graph(id='survey_plot'),
+                    dbc.Progress(id='survey_progress', value=0, striped=True),
+                    dcc.Interval(id='survey_interval', interval=1000, disabled=True)
                 ]),
             ]
         )
@@ -231,7 +276,8 @@ interp_plot_card = dbc.Card(
         dbc.CardHeader(
             dbc.Tabs([
                 dbc.Tab(label="Gravity+ from Survey with DTM Gravity", tab_id="interp_tab_1"),
-                dbc.Tab(label="Gravity+ from Survey", tab_id="interp_tab_2")
+                dbc.Tab(label="Gravity+ from Survey", tab_id="interp_tab_2"),
+                dbc.Tab(label="Leave-One-Out RMS Error", tab_id="interp_tab_3")
             ], id='interp_tabs', card=True, active_tab='interp_tab_1')
         ),
         dbc.CardBody(
@@ -254,6 +300,10 @@ interp_opts_card = dbc.Card([
                                {'label': "Linear", 'value': 'linear'},
                                {'label': "Cubic", 'value': 'cubic'},
                                {'label': "Nearest-Neighbour", 'value': 'nearest'},
+                               {'label': "Minimum Curvature", 'value': 'mincurv'},
+                               {'label': "Radial Basis Functions", 'value': 'rbf'},
+                               {'label': "Kriging", 'value': 'kriging'},
+                               {'label': "Equivalent Sources", 'value': 'eqs'},
                            ],
                            persistence=True),
 
@@ -269,6 +319,10 @@ interp_opts_card = dbc.Card([
             dbc.FormText("No survey points in memory.",
                          id='interp_button_text')
         ]),
+        dbc.FormGroup([
+            dbc.Label("Leave-One-Out Cross-Validation"),
+            html.Div(id='cv_table')
+        ]),
     ])
 ])
 
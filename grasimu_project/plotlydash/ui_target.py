@@ -142,6 +142,12 @@ vox_opts_card = dbc.Card([
             ]),
             dbc.FormText("Size of each cubic voxel along its 3 dimensions.")
         ]),
+        dbc.FormGroup([
+            dbc.Checkbox(id='voxel_fraction_checkbox', className='form-check-input', persistence=True),
+            dbc.Label('Fractional occupancy', html_for='voxel_fraction_checkbox', className='form-check-label'),
+            dbc.FormText("Weight voxels cut by the target surface by the fraction of their volume inside it, "
+                         "allowing coarser voxels for the same accuracy.")
+        ], check=True),
         dbc.FormGroup([
             dbc.Button('Voxelize Mesh',
                        id='voxel_button',
@@ -341,6 +347,8 @@ target_grav_plot_card = dbc.Card(
                 dbc.Col([
                     dbc.Label("Gravity at Surface (z=0)"),
                     dcc.Graph(id='target_grav_plot'),
+                    dbc.Progress(id='gravity_progress', value=0, striped=True),
+                    dcc.Interval(id='gravity_interval', interval=1000, disabled=True),
 
                 ])
             ]
@@ -128,7 +128,8 @@ terrain_opts_card = dbc.Card([
                            color='primary',
                            size='lg',
                            outline=True,
-                           block=True)
+                           block=True),
+                dcc.Interval(id='terrain_interval', interval=1000, disabled=True)
 
             ]),
 
@@ -226,6 +227,16 @@ tgrav_opts_card = dbc.Card([
             dbc.FormText("No DTM+ in memory.",
                          id='tgrav_button_text')
         ]),
+        dbc.FormGroup([
+            dbc.Progress(id='tgrav_progress', value=0, striped=True),
+            dbc.Button('Cancel',
+                       id='tgrav_cancel_button',
+                       color='danger',
+                       size='sm',
+                       outline=True,
+                       block=True),
+            dcc.Interval(id='tgrav_interval', interval=1000, disabled=True)
+        ]),
     ])
 ])
 
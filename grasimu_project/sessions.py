@@ -0,0 +1,200 @@
+import os
+import pickle
+import threading
+import time
+import types
+from collections import OrderedDict
+
+import numpy as np
+
+from .store import ArtifactStore
+
+
+def array_bytes(value, seen=None):
+    """
+    Bytes of memory held by the numpy arrays reachable from value.
+
+    Dicts, lists, tuples and object attributes are followed, and each array buffer is
+    counted once however many views of it there are. Memory-mapped arrays are backed by
+    files rather than memory, so they are not counted.
+    """
+    seen = set() if seen is None else seen
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+        if id(value) in seen or isinstance(value, np.memmap):
+            return 0
+        seen.add(id(value))
+        return value.nbytes
+    if id(value) in seen or isinstance(value, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, dict):
+        children = value.values()
+    elif isinstance(value, (list, tuple, set)):
+        children = value
+    elif hasattr(value, '__dict__'):
+        children = vars(value).values()
+    elif hasattr(type(value), '__slots__'):
+        children = [getattr(value, name, None) for name in type(value).__slots__]
+    else:
+        return 0
+    return sum(array_bytes(child, seen) for child in children)
+
+
+class SceneRegistry:
+    """
+    Scenes of the sessions connected to the dashboard, created on their first request.
+
+    Each session works on its own Scene, so concurrent users do not overwrite each other's
+    products. The registry keeps the memory held by all scenes within max_bytes: sessions
+    idle for longer than idle_timeout seconds, then the least recently used sessions, are
+    evicted. The size of each scene is cached until a request using it is committed, and
+    the limit is checked when a scene is brought into memory and otherwise every
+    collect_interval seconds, so requests do not walk every scene. With an artifact
+    store, an evicted scene is pickled into a sessions directory of it, which the store's
+    size limit does not apply to, and restored on the session's next request; without
+    one, it is discarded. Sessions with a request in flight, from get until commit, are
+    never evicted.
+
+    With a SceneState, scenes are shared by the server's worker processes: a scene saved
+    by another process since this one last had it is loaded from the state again, commit
+    saves the scenes used by the current request, and evicted scenes are left in the state
+    rather than the artifact store. Saves are compare-and-swap on the scene's version, so
+    when two processes change the same scene at once, the one saved first is kept and the
+    other process loads it on its next request.
+    """
+
+    def __init__(self, factory, store=None, max_bytes=2 ** 31, idle_timeout=3600, state=None, collect_interval=10):
+        self.factory = factory
+        self.store = None if store is None else ArtifactStore(os.path.join(store.root, '.sessions'), max_bytes=None)
+        self.state = state
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.collect_interval = collect_interval
+        # Scenes in order of last use, least recently used first
+        self._scenes = OrderedDict()
+        self._used = dict()
+        # Array bytes of the scenes whose size is known, by session
+        self._bytes = dict()
+        self._collected = time.monotonic()
+        self._lock = threading.RLock()
+        # Scenes used by the request each thread is serving, by session, and the number of
+        # requests in flight using each session
+        self._requests = threading.local()
+        self._active = dict()
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def __contains__(self, session):
+        return session in self._scenes
+
+    def get(self, session):
+        """The Scene of session, restored or created if it is not in memory, recorded for commit."""
+        if not hasattr(self._requests, 'scenes'):
+            self._requests.scenes = dict()
+        with self._lock:
+            if session not in self._requests.scenes:
+                self._active[session] = self._active.get(session, 0) + 1
+            scene = self._requests.scenes[session] = self.current(session)
+        return scene
+
+    def current(self, session):
+        """
+        The latest Scene of session, restored or created if it is not in memory.
+
+        Unlike get, the session is not recorded as used by the current request, so this is
+        for work done outside requests, such as writing back the results of jobs.
+        """
+        with self._lock:
+            scene = self._scenes.get(session)
+            if self.state is not None:
+                version = self.state.version(session)
+                if version is not None and (scene is None or scene.state_version != version):
+                    scene, version = self.state.load(session)
+                    scene.state, scene.state_version = self.state, version
+            if scene is None:
+                scene = self._restore(session)
+            if scene is None:
+                scene = self.factory(session)
+            loaded = scene is not self._scenes.get(session)
+            if loaded:
+                self._bytes.pop(session, None)
+            self._scenes[session] = scene
+            self._scenes.move_to_end(session)
+            self._used[session] = now = time.monotonic()
+            if loaded or now - self._collected > self.collect_interval:
+                self.collect(keep=session)
+        return scene
+
+    def commit(self):
+        """Saves the scenes used by the current thread's request to the state, e.g. after each request."""
+        scenes = getattr(self._requests, 'scenes', dict())
+        self._requests.scenes = dict()
+        for session, scene in scenes.items():
+            try:
+                scene.save()
+            finally:
+                with self._lock:
+                    self._active[session] -= 1
+                    if not self._active[session]:
+                        del self._active[session]
+                    # The request may have changed the scene's products, so it is measured again
+                    self._bytes.pop(session, None)
+
+    def memory(self):
+        """Bytes of array memory held by the scene of each session in memory."""
+        usage = dict()
+        with self._lock:
+            for session, scene in self._scenes.items():
+                size = self._bytes.get(session)
+                if size is None:
+                    size = self._bytes[session] = array_bytes(scene)
+                usage[session] = size
+        return usage
+
+    def collect(self, keep=None):
+        """Evicts idle sessions, then the least recently used sessions until the scenes fit in max_bytes."""
+        with self._lock:
+            now = self._collected = time.monotonic()
+            for session in list(self._scenes):
+                if session != keep and session not in self._active and now - self._used[session] > self.idle_timeout:
+                    self.evict(session)
+
+            usage = self.memory()
+            total = sum(usage.values())
+            for session in list(self._scenes):
+                if total <= self.max_bytes:
+                    break
+                if session != keep and session not in self._active:
+                    self.evict(session)
+                    total -= usage[session]
+
+    def evict(self, session):
+        """Removes the scene of session from memory, moving it to the state or artifact store if there is one."""
+        with self._lock:
+            scene = self._scenes.pop(session)
+            del self._used[session]
+            self._bytes.pop(session, None)
+            if self.state is not None:
+                # A scene that cannot be saved now is saved by its running calculations
+                scene.save()
+            elif self.store is not None:
+                data = pickle.dumps(scene, protocol=pickle.HIGHEST_PROTOCOL)
+                self.store.put(self._key(session), dict(scene=np.frombuffer(data, dtype=np.uint8)))
+
+    def _key(self, session):
+        return self.store.key('session', session=session)
+
+    def _restore(self, session):
+        if self.store is None:
+            return None
+        key = self._key(session)
+        arrays = self.store.get(key)
+        if arrays is None:
+            return None
+        # The stored copy is out of date as soon as the scene changes again
+        self.store.remove(key)
+        return pickle.loads(arrays['scene'].tobytes())
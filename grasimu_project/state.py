@@ -0,0 +1,262 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (session TEXT PRIMARY KEY, version INTEGER, updated REAL, checksum TEXT,
+                                   data BLOB);
+CREATE TABLE IF NOT EXISTS refs (session TEXT, digest TEXT, PRIMARY KEY (session, digest));
+CREATE TABLE IF NOT EXISTS shared (name TEXT, key TEXT, value TEXT, PRIMARY KEY (name, key));
+"""
+
+
+class StateConflict(Exception):
+    """Raised on saving a Scene that another process has saved since this copy was loaded."""
+
+
+class _Connections:
+    """sqlite connections to one database, one per thread and process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def get(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+
+class SharedDict:
+    """
+    Dict of JSON values in the state database, shared by every process using it.
+
+    Keys may be strings or tuples of strings. Only get, item assignment, pop and
+    iteration over keys are supported, which is what job status and progress need.
+    """
+
+    def __init__(self, connections, name):
+        self._connections = connections
+        self.name = name
+
+    def get(self, key, default=None):
+        row = self._connections.get().execute('SELECT value FROM shared WHERE name = ? AND key = ?',
+                                              (self.name, json.dumps(key))).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._connections.get().execute('INSERT OR REPLACE INTO shared (name, key, value) VALUES (?, ?, ?)',
+                                        (self.name, json.dumps(key), json.dumps(value)))
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self._connections.get().execute('DELETE FROM shared WHERE name = ? AND key = ?',
+                                        (self.name, json.dumps(key)))
+        return value
+
+    def keys(self):
+        keys = [json.loads(key) for key, in
+                self._connections.get().execute('SELECT key FROM shared WHERE name = ?', (self.name,))]
+        return [tuple(key) if isinstance(key, list) else key for key in keys]
+
+
+class SceneState:
+    """
+    Scenes of all sessions in a local state directory, shared by the server's worker processes.
+
+    A Scene is pickled with its large arrays stored separately, as .npy files named by the
+    hash of their contents, so unchanged arrays are written once however often the Scene
+    is saved. Loading memory-maps them read-only, so every process sees the same pages
+    without copying them. The pickles, with a version number that increases on every
+    save, and small shared tables live in a sqlite database. Array files no longer used by
+    any session are deleted when the session that used them last is saved or removed, and
+    sessions not saved for max_age seconds are removed.
+
+    Arrays are hashed once per process: Scene products are replaced rather than modified
+    in place, so an array object keeps the contents it was first saved with. Saving makes
+    the arrays it hashes read-only, with the arrays they are views of, so writing into one
+    later raises instead of leaving the stored copy silently out of date.
+    """
+
+    def __init__(self, root, max_age=7 * 24 * 3600, min_bytes=2 ** 16):
+        self.root = os.path.abspath(root)
+        self.max_age = max_age
+        self.min_bytes = min_bytes
+        # Hashes of the arrays saved by this process, by id while they are alive
+        self._digests = dict()
+        os.makedirs(os.path.join(self.root, 'arrays'), exist_ok=True)
+        self._connections = _Connections(os.path.join(self.root, 'state.sqlite'))
+        self._connections.get().executescript(SCHEMA)
+
+    def shared(self, name):
+        """SharedDict called name in the state database."""
+        return SharedDict(self._connections, name)
+
+    def _array_path(self, digest):
+        return os.path.join(self.root, 'arrays', digest + '.npy')
+
+    def _digest(self, array):
+        """Hash of the contents, shape and dtype of array, which names its file."""
+        # Arrays loaded whole from the state directory are already stored under their file name
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and \
+                os.path.dirname(os.path.abspath(array.filename)) == os.path.join(self.root, 'arrays'):
+            return os.path.basename(array.filename)[:-4]
+        key = id(array)
+        known = self._digests.get(key)
+        if known is not None and known[0]() is array:
+            return known[1]
+        contiguous = np.ascontiguousarray(array)
+        digest = hashlib.sha256('{}{}'.format(contiguous.shape, contiguous.dtype.str).encode())
+        digest.update(contiguous.tobytes())
+        digest = digest.hexdigest()
+        base = array
+        while isinstance(base, np.ndarray):
+            base.flags.writeable = False
+            base = base.base
+        self._digests[key] = (weakref.ref(array, lambda ref: self._digests.pop(key, None)), digest)
+        return digest
+
+    def _write_array(self, digest, array):
+        """Writes the file of array, unless it is there already."""
+        path = self._array_path(digest)
+        if not os.path.exists(path):
+            handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(handle, 'wb') as file:
+                np.save(file, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(temporary, path)
+
+    def version(self, session):
+        """Version of the stored Scene of session, or None if there is none."""
+        row = self._connections.get().execute('SELECT version FROM scenes WHERE session = ?', (session,)).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, session, scene, version=None):
+        """
+        Stores scene as the Scene of session and returns its new version.
+
+        version is the version scene was loaded or last saved as, None for a new Scene. The
+        save only succeeds if that is still the stored version, so a copy that is out of
+        date never overwrites changes saved by another process: StateConflict is raised
+        instead. If scene has not changed since, nothing is written and version is returned.
+        """
+        digests = dict()
+
+        def persistent_id(value):
+            # Object arrays hold Python objects, which are pickled with the rest of the Scene
+            if isinstance(value, np.ndarray) and value.nbytes >= self.min_bytes and not value.dtype.hasobject:
+                digest = self._digest(value)
+                self._write_array(digest, value)
+                digests[digest] = value
+                return digest
+            return None
+
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(scene)
+        data = buffer.getvalue()
+        checksum = hashlib.sha256(data).hexdigest()
+
+        connection = self._connections.get()
+        try:
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                stored = connection.execute('SELECT version, checksum FROM scenes WHERE session = ?',
+                                            (session,)).fetchone()
+                if stored is not None and stored[0] != version:
+                    raise StateConflict('Scene {} is at version {}, not {}'.format(session, stored[0], version))
+                if stored is not None and stored[1] == checksum:
+                    return version
+                # A file that existed when it was skipped may have been collected since
+                for digest, array in digests.items():
+                    self._write_array(digest, array)
+                version = (stored[0] if stored is not None else 0) + 1
+                connection.execute('INSERT OR REPLACE INTO scenes (session, version, updated, checksum, data) '
+                                   'VALUES (?, ?, ?, ?, ?)', (session, version, time.time(), checksum, data))
+                previous = {d for d, in connection.execute('SELECT digest FROM refs WHERE session = ?',
+                                                           (session,))}
+                connection.execute('DELETE FROM refs WHERE session = ?', (session,))
+                connection.executemany('INSERT INTO refs (session, digest) VALUES (?, ?)',
+                                       [(session, digest) for digest in digests])
+        except StateConflict:
+            # The array files written for this copy may be used by no session
+            self._collect(set(digests))
+            raise
+        self._collect(previous - set(digests))
+        self.expire()
+        return version
+
+    def load(self, session):
+        """The stored Scene of session and its version, or None and None if there is none."""
+        row = self._connections.get().execute('SELECT data, version FROM scenes WHERE session = ?',
+                                              (session,)).fetchone()
+        if row is None:
+            return None, None
+
+        def persistent_load(digest):
+            return np.load(self._array_path(digest), mmap_mode='r', allow_pickle=False)
+
+        unpickler = pickle.Unpickler(io.BytesIO(row[0]))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load(), row[1]
+
+    def remove(self, session):
+        connection = self._connections.get()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            digests = {d for d, in connection.execute('SELECT digest FROM refs WHERE session = ?', (session,))}
+            connection.execute('DELETE FROM refs WHERE session = ?', (session,))
+            connection.execute('DELETE FROM scenes WHERE session = ?', (session,))
+        self._collect(digests)
+
+    def sessions(self):
+        """Stored sessions with the time each was last saved."""
+        return dict(self._connections.get().execute('SELECT session, updated FROM scenes'))
+
+    def expire(self, max_age=None):
+        """Removes the sessions not saved for max_age seconds, by default the state's max_age."""
+        max_age = self.max_age if max_age is None else max_age
+        now = time.time()
+        for session, updated in self.sessions().items():
+            if now - updated > max_age:
+                self.remove(session)
+
+    def _collect(self, digests):
+        """Deletes the array files of digests that no session refers to."""
+        connection = self._connections.get()
+        with connection:
+            # Saves check their files in the same kind of transaction, so none is lost in between
+            connection.execute('BEGIN IMMEDIATE')
+            for digest in digests:
+                if connection.execute('SELECT 1 FROM refs WHERE digest = ? LIMIT 1', (digest,)).fetchone() is None:
+                    # Processes that have the file mapped keep their pages until they let go of it
+                    try:
+                        os.remove(self._array_path(digest))
+                    except FileNotFoundError:
+                        pass
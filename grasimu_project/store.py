@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+
+def _update(digest, value):
+    """Feeds a canonical encoding of value into digest; arrays are hashed by contents, shape and dtype."""
+    if isinstance(value, np.ndarray):
+        digest.update('array{}{}'.format(value.shape, value.dtype.str).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update('{}{}'.format(type(value).__name__, len(value)).encode())
+        for v in value:
+            _update(digest, v)
+    elif isinstance(value, dict):
+        digest.update('dict{}'.format(len(value)).encode())
+        for k in sorted(value):
+            _update(digest, k)
+            _update(digest, value[k])
+    elif isinstance(value, np.generic):
+        _update(digest, value.item())
+    elif value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        digest.update('{}:{!r}'.format(type(value).__name__, value).encode())
+    else:
+        raise TypeError('Cannot key an artifact on {}'.format(type(value).__name__))
+
+
+# File listing the names of an artifact's arrays
+MANIFEST = 'manifest.json'
+# Prefix of the directories artifacts are written to before being renamed into place, and
+# the age after which one is taken to be left behind by a writer that crashed
+STAGING = '.staging-'
+STAGING_MAX_AGE = 3600
+
+
+class ArtifactStore:
+    """
+    On-disk, content-addressed cache of the arrays produced by expensive Scene stages.
+
+    An artifact is keyed by a sha256 hash of the stage name and all of its inputs, so a
+    stage run again with the same inputs, in this process or after a restart, loads its
+    result instead of recalculating it. Each artifact is a directory of .npy files that are
+    memory-mapped read-only on loading. Artifacts are written to a temporary directory and
+    renamed into place, so concurrent writers and interrupted writes never leave a partial
+    entry. When the store grows beyond max_bytes, the least recently used artifacts are
+    removed; with max_bytes None, none are. Each artifact lists its arrays in a manifest,
+    so one read while it is being removed is a cache miss rather than a partial result,
+    and is replaced when stored again.
+    """
+
+    def __init__(self, root, max_bytes=2 ** 32):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, stage, **inputs):
+        digest = hashlib.sha256()
+        _update(digest, stage)
+        _update(digest, inputs)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """The arrays stored under key by name, memory-mapped, or None if there is no complete artifact."""
+        path = self.path(key)
+        try:
+            with open(os.path.join(path, MANIFEST)) as file:
+                names = json.load(file)
+            arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+                      for name in names}
+        except (FileNotFoundError, ValueError):
+            # Missing, or removed by eviction while being read
+            return None
+        # The modification time of an artifact is its last use
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def put(self, key, arrays):
+        """Stores the dict of arrays under key and returns them as loaded from the store."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=STAGING + key[:8], dir=self.root)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, name + '.npy'), np.asarray(array), allow_pickle=False)
+            with open(os.path.join(staging, MANIFEST), 'w') as file:
+                json.dump(sorted(arrays), file)
+            if os.path.isdir(path) and self.get(key) is None:
+                # An incomplete entry, e.g. left by an interrupted eviction, would never be replaced
+                self.remove(key)
+            os.rename(staging, path)
+        except OSError:
+            # Another writer stored the same artifact first
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        self.evict()
+        stored = self.get(key)
+        return stored if stored is not None else arrays
+
+    def remove(self, key):
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def entries(self):
+        """Paths, sizes and last use times of all artifacts."""
+        entries = []
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir() or prefix.name.startswith('.'):
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.path, size, entry.stat().st_mtime))
+                except FileNotFoundError:
+                    continue
+        return entries
+
+    def size(self):
+        return sum(size for path, size, used in self.entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Removes the least recently used artifacts until the store holds at most max_bytes,
+        and the staging directories of writes that never finished.
+        """
+        now = time.time()
+        for entry in os.scandir(self.root):
+            try:
+                if entry.name.startswith(STAGING) and now - entry.stat().st_mtime > STAGING_MAX_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for path, size, used in entries)
+        for path, size, used in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def cached(self, stage, compute, **inputs):
+        """
+        Result of stage for inputs: loaded from the store if it has been stored before,
+        otherwise calculated by compute, which returns a dict of arrays, and stored.
+        """
+        key = self.key(stage, **inputs)
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = self.put(key, compute())
+        return arrays
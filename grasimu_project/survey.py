@@ -0,0 +1,121 @@
+import re
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+
+def grid_layout(bounds, dx, dy):
+    """Regular grid of stations spaced dx, dy over bounds [x_min, y_min, x_max, y_max]."""
+    x = np.arange(bounds[0], bounds[2] + dx / 2, dx)
+    y = np.arange(bounds[1], bounds[3] + dy / 2, dy)
+    xx, yy = np.meshgrid(x, y)
+    return xx.ravel(), yy.ravel()
+
+
+def staggered_layout(bounds, dx, dy):
+    """Grid of stations with every other row offset by half a station spacing."""
+    xx, yy = grid_layout(bounds, dx, dy)
+    row = np.rint((yy - bounds[1]) / dy).astype(int)
+    xx = xx + (row % 2) * dx / 2
+    inside = xx <= bounds[2]
+    return xx[inside], yy[inside]
+
+
+def spiral_layout(centre, radius, turns, points):
+    """
+    Archimedean spiral of points stations from centre out to radius over turns turns.
+
+    Stations are spaced evenly along the spiral rather than in angle, so the density of
+    stations is about uniform over the area covered.
+    """
+    theta_max = 2 * np.pi * turns
+    # Arc length of r = a * theta grows about as theta ** 2
+    theta = theta_max * np.sqrt(np.linspace(0, 1, int(points)))
+    r = radius * theta / theta_max
+    return centre[0] + r * np.cos(theta), centre[1] + r * np.sin(theta)
+
+
+def line_layout(start, end, spacing, lines=1, line_spacing=0):
+    """
+    Stations every spacing metres along the line from start to end.
+
+    With lines > 1, parallel lines are added line_spacing apart to the left of the first.
+    """
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    length = np.hypot(*(end - start))
+    direction = (end - start) / length if length else np.array([1.0, 0.0])
+    normal = np.array([-direction[1], direction[0]])
+
+    along = np.arange(0, length + spacing / 2, spacing)
+    across = np.arange(int(lines)) * line_spacing
+    a, b = np.meshgrid(along, across)
+    xy = start + a.ravel()[:, None] * direction + b.ravel()[:, None] * normal
+    return xy[:, 0], xy[:, 1]
+
+
+def clip_to_bounds(x, y, bounds):
+    """Mask of the stations x, y inside bounds [x_min, y_min, x_max, y_max]."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return (x >= bounds[0]) & (x <= bounds[2]) & (y >= bounds[1]) & (y <= bounds[3])
+
+
+# Header names accepted for each station file column, the first four in the order of a file without a header
+STATION_COLUMNS = dict(x=['x', 'easting'],
+                       y=['y', 'northing'],
+                       z=['z', 'height'],
+                       time=['time', 'timestamp', 'datetime'],
+                       elevation=['elevation', 'altitude'])
+
+
+def read_stations(text, ground=None):
+    """
+    Reads survey stations from CSV or whitespace-separated text.
+
+    Columns are x, y and optionally z (height above the ground) and a timestamp, in that
+    order, or named in a header row. Rows without numeric coordinates are dropped, a
+    missing z is 0, and stations with timestamps are returned in time order. Returns a
+    DataFrame with columns x, y, z.
+
+    A named elevation column is converted to z by subtracting the height of the ground at
+    each station, given by ground(x, y); without ground it raises ValueError.
+    """
+    first = text.lstrip().split('\n', 1)[0]
+    sep = ',' if ',' in first else r'\s+'
+    try:
+        float(re.split(sep, first.strip())[0])
+        header = None
+    except ValueError:
+        header = 0
+
+    stations = pd.read_csv(StringIO(text), sep=sep, header=header, skipinitialspace=True)
+    if header is None:
+        positional = ['x', 'y', 'z', 'time']
+        stations.columns = positional[:stations.shape[1]] + list(stations.columns[len(positional):])
+    else:
+        aliases = {alias: name for name, names in STATION_COLUMNS.items() for alias in names}
+        stations.columns = [aliases.get(str(c).strip().lower(), c) for c in stations.columns]
+
+    for name in ['x', 'y', 'z', 'elevation']:
+        if name in stations:
+            stations[name] = pd.to_numeric(stations[name], errors='coerce')
+    stations = stations.dropna(subset=['x', 'y'])
+    if 'elevation' in stations and 'z' not in stations:
+        if ground is None:
+            raise ValueError('station elevations need a terrain to convert them to heights above the ground')
+        stations['z'] = stations['elevation'] - ground(stations['x'].to_numpy(), stations['y'].to_numpy())
+    stations['z'] = stations['z'].fillna(0) if 'z' in stations else 0.0
+
+    if 'time' in stations:
+        stations['time'] = pd.to_datetime(stations['time'], errors='coerce')
+        stations = stations.sort_values('time', kind='mergesort')
+    return stations[['x', 'y', 'z']].reset_index(drop=True)
+
+
+# Station generators by layout name
+LAYOUTS = dict(grid=grid_layout,
+               staggered=staggered_layout,
+               spiral=spiral_layout,
+               line=line_layout)
@@ -0,0 +1,321 @@
+import numpy as np
+
+
+def sphere(centre, radius):
+    """Signed distance function and bounds of a sphere."""
+    cx, cy, cz = centre
+
+    def sdf(x, y, z):
+        return np.sqrt((x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2) - radius
+
+    bounds = [cx - radius, cx + radius, cy - radius, cy + radius, cz - radius, cz + radius]
+    return sdf, bounds
+
+
+def cylinder(centre, radius, length, axis=0):
+    """Signed distance function and bounds of a capped cylinder.
+
+    The default axis is x, matching the horizontal tube built by pv.Cylinder.
+    """
+    centre = np.asarray(centre, dtype=float)
+    across = [i for i in range(3) if i != axis]
+
+    def sdf(x, y, z):
+        p = (x - centre[0], y - centre[1], z - centre[2])
+        d_radial = np.sqrt(p[across[0]] ** 2 + p[across[1]] ** 2) - radius
+        d_axial = np.abs(p[axis]) - length / 2
+        outside = np.sqrt(np.maximum(d_radial, 0) ** 2 + np.maximum(d_axial, 0) ** 2)
+        inside = np.minimum(np.maximum(d_radial, d_axial), 0)
+        return outside + inside
+
+    half = np.full(3, float(radius))
+    half[axis] = length / 2
+    bounds = np.column_stack([centre - half, centre + half]).ravel().tolist()
+    return sdf, bounds
+
+
+def ellipsoid(centre, radii):
+    """Approximate signed distance function and bounds of an axis-aligned ellipsoid.
+
+    The distance is only exact on the surface, but its sign is exact everywhere.
+    """
+    cx, cy, cz = centre
+    rx, ry, rz = radii
+
+    def sdf(x, y, z):
+        k0 = np.sqrt(((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2 + ((z - cz) / rz) ** 2)
+        k1 = np.sqrt(((x - cx) / rx ** 2) ** 2 + ((y - cy) / ry ** 2) ** 2 + ((z - cz) / rz ** 2) ** 2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dist = k0 * (k0 - 1) / k1
+        return np.where(k1 > 0, dist, -min(radii))
+
+    bounds = [cx - rx, cx + rx, cy - ry, cy + ry, cz - rz, cz + rz]
+    return sdf, bounds
+
+
+def box(centre, size):
+    """Signed distance function and bounds of an axis-aligned box."""
+    centre = np.asarray(centre, dtype=float)
+    half = np.asarray(size, dtype=float) / 2
+
+    def sdf(x, y, z):
+        qx = np.abs(x - centre[0]) - half[0]
+        qy = np.abs(y - centre[1]) - half[1]
+        qz = np.abs(z - centre[2]) - half[2]
+        outside = np.sqrt(np.maximum(qx, 0) ** 2 + np.maximum(qy, 0) ** 2 + np.maximum(qz, 0) ** 2)
+        inside = np.minimum(np.maximum(qx, np.maximum(qy, qz)), 0)
+        return outside + inside
+
+    bounds = np.column_stack([centre - half, centre + half]).ravel().tolist()
+    return sdf, bounds
+
+
+# Parametric primitives that can be voxelized without building a surface mesh.
+# Each entry returns (sdf, bounds) where bounds is [x_min, x_max, y_min, y_max, z_min, z_max].
+# Each is called with centre and the shape's own parameters, e.g. radii for an ellipsoid.
+IMPLICIT_SHAPES = dict(sphere=sphere,
+                       cylinder=cylinder,
+                       tube=cylinder,
+                       ellipsoid=ellipsoid,
+                       box=box)
+
+
+def _lattice(bounds, resolution):
+    """Lattice of cubic cells covering the bounds, centred on them, with i varying fastest."""
+    bounds = np.asarray(bounds, dtype=float)
+    extent = bounds[1::2] - bounds[::2]
+    dims = np.maximum(np.ceil(extent / resolution).astype(int), 1)
+
+    # Centre the lattice on the shape so that symmetric shapes give symmetric voxel models
+    origin = bounds[::2] - (dims * resolution - extent) / 2
+
+    i, j, k = np.meshgrid(np.arange(dims[0]), np.arange(dims[1]), np.arange(dims[2]), indexing='ij')
+    ijk = np.column_stack([i.ravel(order='F'), j.ravel(order='F'), k.ravel(order='F')])
+    centres = origin + (ijk + 0.5) * resolution
+    return origin, dims, ijk, centres
+
+
+def _supersample(inside, centres, resolution, subsamples, chunk_size):
+    """Fraction of each cell's volume that lies inside, from subsamples**3 points per cell."""
+    offsets = (np.arange(subsamples) + 0.5) / subsamples - 0.5
+    ox, oy, oz = np.meshgrid(offsets, offsets, offsets, indexing='ij')
+    offsets = np.column_stack([ox.ravel(), oy.ravel(), oz.ravel()]) * resolution
+
+    fraction = np.zeros(len(centres))
+    step = max(1, chunk_size // len(offsets))
+    for start in range(0, len(centres), step):
+        pts = (centres[start:start + step, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        within = inside(pts[:, 0], pts[:, 1], pts[:, 2]).reshape(-1, len(offsets))
+        fraction[start:start + step] = np.mean(within, axis=1)
+    return fraction
+
+
+def _result(origin, resolution, dims, ijk, centres, filled, fraction):
+    return dict(origin=origin,
+                spacing=resolution,
+                dims=dims,
+                ijk=ijk[filled],
+                centres=centres[filled],
+                fraction=fraction)
+
+
+def voxelize_implicit(sdf, bounds, resolution, fractional=False, subsamples=4, chunk_size=100000):
+    """
+    Voxelizes a shape given by its signed distance function on a lattice of cubic cells.
+
+    Cells whose centre lies inside the shape are filled. With fractional=True, cells that
+    straddle the surface are supersampled with subsamples**3 points and keep the fraction
+    of their volume that lies inside, so partially covered cells are kept as well.
+
+    Returns a dict with the lattice origin, spacing and dims, the i, j, k indices and
+    centres of the filled cells, and their volume fraction (None if not fractional).
+    Cells are ordered with i varying fastest, as in VTK image data.
+    """
+    origin, dims, ijk, centres = _lattice(bounds, resolution)
+    dist = sdf(centres[:, 0], centres[:, 1], centres[:, 2])
+
+    if not fractional:
+        return _result(origin, resolution, dims, ijk, centres, dist <= 0, None)
+
+    # A cell can only be cut by the surface if its centre is within half a diagonal of it
+    fraction = (dist <= 0).astype(float)
+    boundary = np.abs(dist) < np.sqrt(3) / 2 * resolution
+    fraction[boundary] = _supersample(lambda x, y, z: sdf(x, y, z) <= 0,
+                                      centres[boundary], resolution, subsamples, chunk_size)
+    filled = fraction > 0
+    return _result(origin, resolution, dims, ijk, centres, filled, fraction[filled])
+
+
+def voxelize_inside(inside, bounds, resolution, subsamples=4, chunk_size=100000):
+    """
+    Voxelizes a closed shape given only by a point-in-shape test, with volume fractions.
+
+    The test is run once on the lattice nodes and cell centres. Cells with all corners and
+    their centre inside are full, cells with none of them inside are empty, and the rest
+    are supersampled like the boundary cells of voxelize_implicit.
+    """
+    origin, dims, ijk, centres = _lattice(bounds, resolution)
+
+    nx, ny, nz = dims + 1
+    i, j, k = np.meshgrid(np.arange(nx), np.arange(ny), np.arange(nz), indexing='ij')
+    nodes = origin + np.column_stack([i.ravel(), j.ravel(), k.ravel()]) * resolution
+    node_in = inside(nodes[:, 0], nodes[:, 1], nodes[:, 2]).reshape(nx, ny, nz)
+
+    corners = sum(node_in[a:nx - 1 + a, b:ny - 1 + b, c:nz - 1 + c].astype(int)
+                  for a in (0, 1) for b in (0, 1) for c in (0, 1))
+    corners = corners.ravel(order='F') + inside(centres[:, 0], centres[:, 1], centres[:, 2])
+
+    fraction = (corners == 9).astype(float)
+    boundary = (corners > 0) & (corners < 9)
+    fraction[boundary] = _supersample(inside, centres[boundary], resolution, subsamples, chunk_size)
+    filled = fraction > 0
+    return _result(origin, resolution, dims, ijk, centres, filled, fraction[filled])
+
+
+# Offsets to the six face neighbours of a voxel, as (axis, step) pairs
+FACE_NEIGHBOURS = [(0, -1), (0, 1), (1, -1), (1, 1), (2, -1), (2, 1)]
+
+
+class VoxelModel:
+    """
+    Voxel model stored as integer lattice indices with a common origin and spacing.
+
+    Cell centres are only computed on demand, so a model takes 6 bytes per voxel
+    (int16 indices) or 12 bytes (int32, for lattices wider than 32767 cells) plus an
+    optional float32 volume fraction, and pickles cheaply for transfer to workers.
+    A dense index grid is built lazily for O(1) neighbour queries.
+    """
+    __slots__ = ('origin', 'spacing', 'dims', 'ijk', 'fraction', '_lookup')
+
+    def __init__(self, origin, spacing, dims, ijk, fraction=None):
+        self.origin = np.asarray(origin, dtype=float)
+        self.spacing = float(spacing)
+        self.dims = np.asarray(dims, dtype=np.int64)
+        dtype = np.int16 if self.dims.max() <= np.iinfo(np.int16).max else np.int32
+        self.ijk = np.asarray(ijk).astype(dtype, copy=False).reshape(-1, 3)
+        self.fraction = None if fraction is None else np.asarray(fraction, dtype=np.float32)
+        self._lookup = None
+
+    @classmethod
+    def from_lattice(cls, lattice):
+        """Builds a model from the output of voxelize_implicit or voxelize_inside."""
+        return cls(lattice['origin'], lattice['spacing'], lattice['dims'], lattice['ijk'], lattice['fraction'])
+
+    @classmethod
+    def from_centres(cls, centres, spacing, origin=None, fraction=None):
+        """Builds a model from the centres of cubic cells lying on a common lattice."""
+        centres = np.asarray(centres, dtype=float)
+        if origin is None:
+            origin = centres.min(axis=0) - spacing / 2
+        ijk = np.round((centres - origin) / spacing - 0.5).astype(np.int64)
+        return cls(origin, spacing, ijk.max(axis=0) + 1, ijk, fraction)
+
+    @classmethod
+    def from_packed(cls, packed, dims, origin, spacing, fraction=None):
+        """Builds a model from a bit-packed occupancy grid, as returned by packed()."""
+        size = int(np.prod(dims))
+        occupied = np.unpackbits(np.asarray(packed, dtype=np.uint8), count=size).astype(bool)
+        ijk = np.column_stack(np.unravel_index(np.nonzero(occupied)[0], tuple(dims), order='F'))
+        return cls(origin, spacing, dims, ijk, fraction)
+
+    def __len__(self):
+        return len(self.ijk)
+
+    def __getstate__(self):
+        return self.origin, self.spacing, self.dims, self.ijk, self.fraction
+
+    def __setstate__(self, state):
+        self.origin, self.spacing, self.dims, self.ijk, self.fraction = state
+        self._lookup = None
+
+    @property
+    def centres(self):
+        return self.origin + (self.ijk + 0.5) * self.spacing
+
+    @property
+    def weights(self):
+        """Volume fraction of each voxel, or ones for a fully occupied model."""
+        if self.fraction is None:
+            return np.ones(len(self))
+        return self.fraction.astype(float)
+
+    @property
+    def bounds(self):
+        lower = self.origin + self.ijk.min(axis=0) * self.spacing
+        upper = self.origin + (self.ijk.max(axis=0) + 1) * self.spacing
+        return np.column_stack([lower, upper]).ravel()
+
+    @property
+    def nbytes(self):
+        return self.ijk.nbytes + (0 if self.fraction is None else self.fraction.nbytes)
+
+    def cell_ids(self):
+        """Flat lattice id of each voxel, with i varying fastest as in VTK image data."""
+        ijk = self.ijk.astype(np.int64)
+        return ijk[:, 0] + self.dims[0] * (ijk[:, 1] + self.dims[1] * ijk[:, 2])
+
+    def occupancy(self):
+        """Dense boolean occupancy grid of shape dims."""
+        grid = np.zeros(tuple(self.dims), dtype=bool)
+        grid[tuple(self.ijk.T)] = True
+        return grid
+
+    def packed(self):
+        """Occupancy grid packed to one bit per lattice cell."""
+        return np.packbits(self.occupancy().ravel(order='F'))
+
+    def lookup(self):
+        """Dense grid holding the index of the voxel in each lattice cell, or -1 if empty."""
+        if self._lookup is None:
+            lookup = np.full(tuple(self.dims), -1, dtype=np.int32)
+            lookup[tuple(self.ijk.T)] = np.arange(len(self), dtype=np.int32)
+            self._lookup = lookup
+        return self._lookup
+
+    def index(self, i, j, k):
+        """Index of the voxel at each lattice position, or -1 where empty or outside the lattice."""
+        pos = np.stack(np.broadcast_arrays(i, j, k), axis=-1).astype(np.int64)
+        valid = np.all((pos >= 0) & (pos < self.dims), axis=-1)
+        clipped = np.clip(pos, 0, self.dims - 1)
+        found = self.lookup()[clipped[..., 0], clipped[..., 1], clipped[..., 2]]
+        return np.where(valid, found, -1)
+
+    def neighbours(self):
+        """Index of the six face neighbours of every voxel (-1 where missing), ordered as FACE_NEIGHBOURS."""
+        ijk = self.ijk.astype(np.int64)
+        neighbours = np.empty((len(self), len(FACE_NEIGHBOURS)), dtype=np.int32)
+        for n, (axis, step) in enumerate(FACE_NEIGHBOURS):
+            pos = ijk.copy()
+            pos[:, axis] += step
+            neighbours[:, n] = self.index(pos[:, 0], pos[:, 1], pos[:, 2])
+        return neighbours
+
+    def surface(self):
+        """
+        Exposed faces of the voxel model as a quad mesh with shared corners.
+
+        Returns the corner vertices and an (n, 4) array of quads indexing them, wound
+        counter-clockwise when seen from outside the model.
+        """
+        ijk = self.ijk.astype(np.int64)
+        neighbours = self.neighbours()
+        faces = []
+        for n, (axis, step) in enumerate(FACE_NEIGHBOURS):
+            exposed = ijk[neighbours[:, n] < 0]
+            u, v = (axis + 1) % 3, (axis + 2) % 3
+            square = [(0, 0), (1, 0), (1, 1), (0, 1)]
+            if step < 0:
+                square = square[::-1]
+            corners = np.repeat(exposed[:, None, :], 4, axis=1)
+            corners[:, :, axis] += step > 0
+            corners[:, :, u] += [du for du, dv in square]
+            corners[:, :, v] += [dv for du, dv in square]
+            faces.append(corners)
+
+        # Corners shared between faces are merged through their lattice node id
+        quads_ijk = np.concatenate(faces, axis=0)
+        node_dims = self.dims + 1
+        node_ids = quads_ijk[..., 0] + node_dims[0] * (quads_ijk[..., 1] + node_dims[1] * quads_ijk[..., 2])
+        unique_ids, quads = np.unique(node_ids.ravel(), return_inverse=True)
+        nodes = np.column_stack(np.unravel_index(unique_ids, tuple(node_dims), order='F'))
+        return self.origin + nodes * self.spacing, quads.reshape(-1, 4)